@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark of the analysis and of the creation of map data.
+   Each comparator is run with each output type, on a synthetic road
+   network and/or on the data of the demo project, and the wall time,
+   peak memory and size of the output files of every stage are written
+   in a JSON file.
+"""
+
+import os
+import sys
+import imp
+import json
+import time
+import random
+import resource
+import argparse
+import platform
+import tempfile
+from math import sqrt
+from shutil import copytree, copyfile
+from multiprocessing import Process, Queue
+from Queue import Empty
+from segments import LocalProjection
+
+COMPARATORS = ["highwaysgeometryspatialite", "highwaysgeometrymemory"]
+OUTPUTS = ["vector", "raster", "mvt"]
+DEMO_TASKS = {"Rimini": {"boundaries_file": "Rimini/boundaries.shp",
+                         "shapefile": "Rimini/archiWGS84.shp"},
+              "Verona": {"boundaries_file": "Verona/boundaries.shp",
+                         "shapefile": ("Verona/CS_GRAFO_STRADALE_RETE_"
+                                       "VIARIA_SHP_lineWGS84.shp")}}
+
+
+def directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+class Stages:
+    """Measure the stages of the analysis of a task, by wrapping the
+       methods that execute them.
+    """
+    def __init__(self):
+        self.stages = []
+        self.task = None
+
+    def wrap(self, owner, name, task_of=None):
+        function = getattr(owner, name)
+
+        def measured(*args, **kwargs):
+            if task_of is not None:
+                self.task = task_of(args[0])
+            stage = name
+            if name == "compare":
+                stage = "compare:{0}".format(args[1])
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, time.time() - start)
+        setattr(owner, name, measured)
+
+    def record(self, stage, seconds):
+        record = {"stage": stage,
+                  "wall_s": round(seconds, 3),
+                  "max_rss_kb": resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss,
+                  "children_max_rss_kb": resource.getrusage(
+                      resource.RUSAGE_CHILDREN).ru_maxrss}
+        # Size of the output files after the stage
+        if self.task is not None:
+            record["output_bytes"] = directory_size(self.task.output_dir)
+            record["map_data_bytes"] = directory_size(
+                self.task.map_data_dir)
+        self.stages.append(record)
+
+
+def run_task(app_file, project_file, comparator, task_name, log_file,
+             queue):
+    """Analyse a task and create its map data in a child process, so that
+       the peak memory of each run is measured separately.
+    """
+    log = open(log_file, "w")
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    result = {"stages": [], "error": ""}
+    start = time.time()
+    try:
+        # Modules are imported here, so that a missing dependency only
+        # makes the runs that need it fail
+        sys.path.insert(0, os.path.dirname(app_file))
+        from comparators.comparator import Comparator
+        from task import Task
+        import rendering.renderer
+        m = __import__("comparators.{0}".format(comparator), globals(),
+                       locals(), [comparator.title()])
+        comparator_class = getattr(m, comparator.title())
+
+        stages = Stages()
+        for name in ("create_db", "compare"):
+            stages.wrap(comparator_class, name, lambda c: c.task)
+        stages.wrap(Comparator, "export", lambda c: c.task)
+        for name in ("update_map_data", "write_topojson",
+                     "write_vector_tiles"):
+            stages.wrap(Task, name, lambda t: t)
+        stages.wrap(rendering.renderer, "render_tiles")
+        result["stages"] = stages.stages
+
+        sys.argv = [app_file, project_file, "--analyse",
+                    "--create_web_page", "--tasks", task_name]
+        app = imp.load_source("compare_to_osm", app_file)
+        app.App()
+    except SystemExit as e:
+        if e.code:
+            result["error"] = str(e.code).strip()
+    except Exception as e:
+        result["error"] = "{0}: {1}".format(e.__class__.__name__, e)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    result["total_s"] = round(time.time() - start, 3)
+    queue.put(result)
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.app_directory = os.path.dirname(os.path.abspath(__file__))
+        self.app_file = os.path.join(self.app_directory, "compare-to-osm.py")
+        if args.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="compare-to-osm-bench-")
+        else:
+            self.directory = os.path.abspath(args.directory)
+        self.runs = []
+
+    def task_config(self, name, comparator, output, open_data):
+        config = {"name": name,
+                  "comparator": comparator,
+                  "data": {"open_data": open_data},
+                  "output": {"type": output}}
+        if output in ("raster", "mvt"):
+            config["output"]["min_zoom"] = self.args.min_zoom
+            config["output"]["max_zoom"] = self.args.max_zoom
+        if comparator.endswith("postgis"):
+            config["postgis_user"] = self.args.postgis_user
+            config["postgis_password"] = self.args.postgis_password
+        return config
+
+    def combinations(self):
+        for comparator in self.args.comparators:
+            for output in self.args.outputs:
+                yield (comparator, output)
+
+    def create_project(self, name, tasks):
+        """Write the project file of tasks, a list of
+           (task config, OSM file).
+        """
+        project_dir = os.path.join(self.directory, name)
+        project_file = os.path.join(project_dir, "project.json")
+        for (config, osm_file) in tasks:
+            osm_dir = os.path.join(project_dir, "data", "osm_data",
+                                   config["name"])
+            if not os.path.exists(osm_dir):
+                os.makedirs(osm_dir)
+            extension = os.path.splitext(osm_file)[1]
+            copyfile(osm_file, os.path.join(
+                osm_dir, "{0}{1}".format(config["name"], extension)))
+        with open(project_file, "w") as fp:
+            fp.write(json.dumps({"title": "Benchmark: {0}".format(name),
+                                 "tasks": [c for (c, f) in tasks]},
+                                sort_keys=True,
+                                indent=4,
+                                separators=(',', ': ')))
+        return project_file
+
+    def synthetic_project(self):
+        """Create a project with a synthetic network for every comparator
+           and output type.
+        """
+        print "\n= Create a synthetic network of about {0} ways".format(
+            self.args.ways)
+        data_dir = os.path.join(self.directory, "synthetic", "data",
+                                "open_data", "synthetic")
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        osm_file = os.path.join(self.directory, "synthetic.osm")
+        counts = write_synthetic_network(data_dir, osm_file,
+                                         self.args.ways,
+                                         self.args.mismatch,
+                                         self.args.seed)
+        print "OSM ways: {0}, open data ways: {1}".format(*counts)
+        open_data = {"boundaries_file": "synthetic/boundaries.shp",
+                     "shapefile": "synthetic/roads.shp"}
+        tasks = []
+        for (comparator, output) in self.combinations():
+            name = "{0}_{1}".format(comparator, output)
+            tasks.append((self.task_config(name, comparator, output,
+                                           open_data), osm_file))
+        info = {"osm_ways": counts[0], "open_data_ways": counts[1]}
+        return (self.create_project("synthetic", tasks), tasks, info)
+
+    def demo_project(self):
+        """Create a project with the data of the demo project for every
+           comparator and output type. The OSM data is the one downloaded
+           for the demo project, so that the benchmark does not change.
+        """
+        print "\n= Copy the data of the demo project"
+        demo_dir = os.path.join(self.app_directory, "projects",
+                                "projectdemo", "data")
+        open_data_dir = os.path.join(self.directory, "demo", "data",
+                                     "open_data")
+        if not os.path.exists(open_data_dir):
+            copytree(os.path.join(demo_dir, "open_data"), open_data_dir)
+        tasks = []
+        for zone in sorted(DEMO_TASKS):
+            osm_file = None
+            for extension in ("pbf", "osm"):
+                path = os.path.join(demo_dir, "osm_data", zone,
+                                    "{0}.{1}".format(zone, extension))
+                if os.path.isfile(path):
+                    osm_file = path
+                    break
+            if osm_file is None:
+                sys.exit("\n* Error: the OSM data of the demo project is "
+                         "missing. Download it once with:\npython "
+                         "./compare-to-osm.py projects/projectdemo/"
+                         "project.json --download_osm --analyse")
+            for (comparator, output) in self.combinations():
+                name = "{0}_{1}_{2}".format(zone, comparator, output)
+                tasks.append((self.task_config(name, comparator, output,
+                                               DEMO_TASKS[zone]),
+                              osm_file))
+        return (self.create_project("demo", tasks), tasks, {})
+
+    def run(self):
+        projects = []
+        if not self.args.demo_only:
+            projects.append(("synthetic", self.synthetic_project()))
+        if self.args.demo or self.args.demo_only:
+            projects.append(("demo", self.demo_project()))
+
+        for (name, (project_file, tasks, info)) in projects:
+            for (config, osm_file) in tasks:
+                print "\n= Run {0}: {1}".format(name, config["name"])
+                log_file = os.path.join(self.directory, name,
+                                        "{0}.log".format(config["name"]))
+                queue = Queue()
+                process = Process(target=run_task,
+                                  args=(self.app_file, project_file,
+                                        config["comparator"], config["name"],
+                                        log_file, queue))
+                process.start()
+                result = None
+                while result is None:
+                    try:
+                        result = queue.get(timeout=1)
+                    except Empty:
+                        # The process ended without a result (e.g. it
+                        # was killed)
+                        if not process.is_alive() and queue.empty():
+                            result = {"stages": [], "total_s": 0,
+                                      "error": "exit code {0}".format(
+                                          process.exitcode)}
+                process.join()
+                run = {"project": name,
+                       "task": config["name"],
+                       "comparator": config["comparator"],
+                       "output": config["output"]["type"],
+                       "log": log_file}
+                run.update(info)
+                run.update(result)
+                self.runs.append(run)
+                self.print_run(run)
+        self.write_results()
+
+    def print_run(self, run):
+        for stage in run["stages"]:
+            print "  {0:<22} {1:>9.3f} s {2:>9} KB".format(
+                stage["stage"], stage["wall_s"], stage["max_rss_kb"])
+        print "  {0:<22} {1:>9.3f} s".format("total", run["total_s"])
+        if run["error"] != "":
+            print "  * Error: {0} (see {1})".format(
+                run["error"].splitlines()[-1], run["log"])
+
+    def write_results(self):
+        results = {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                   "python": platform.python_version(),
+                   "platform": platform.platform(),
+                   "parameters": {"ways": self.args.ways,
+                                  "mismatch": self.args.mismatch,
+                                  "seed": self.args.seed,
+                                  "min_zoom": self.args.min_zoom,
+                                  "max_zoom": self.args.max_zoom},
+                   "runs": self.runs}
+        output = self.args.output
+        if output is None:
+            output = os.path.join(self.directory, "benchmark.json")
+        with open(output, "w") as fp:
+            fp.write(json.dumps(results,
+                                sort_keys=True,
+                                indent=4,
+                                separators=(',', ': ')))
+        print "\nResults written to {0}".format(output)
+
+
+def write_synthetic_network(directory, osm_file, ways, mismatch, seed):
+    """Write a grid of streets as OSM file and as open data shapefile,
+       with the boundaries of the zone. About mismatch * ways ways are
+       missing in one of the two datasets, half of them in OSM. Open data
+       ways are moved by about a meter, like in real data.
+       Return the number of OSM and open data ways.
+    """
+    try:
+        import shapefile
+    except ImportError:
+        sys.exit("\n* Error: pyshp is needed to write the synthetic "
+                 "network. Install it with: pip install pyshp")
+    rand = random.Random(seed)
+    # Streets are 100 m apart, around a point of Northern Italy
+    (lon0, lat0) = (12.0, 44.0)
+    projection = LocalProjection(lat0)
+    step_lon = 100.0 / projection.kx
+    step_lat = 100.0 / projection.ky
+    n = max(int(sqrt(ways / 2.0)) + 1, 2)
+
+    def point(i, j):
+        return (lon0 + i * step_lon, lat0 + j * step_lat)
+
+    def jitter((lon, lat), meters):
+        return (lon + rand.gauss(0, meters) / projection.kx,
+                lat + rand.gauss(0, meters) / projection.ky)
+
+    nodes = {}
+    osm_ways = []
+    open_data_lines = []
+    for i in range(n):
+        for j in range(n):
+            for (k, l) in ((i + 1, j), (i, j + 1)):
+                if k == n or l == n:
+                    continue
+                start = point(i, j)
+                end = point(k, l)
+                middle = jitter(((start[0] + end[0]) / 2,
+                                 (start[1] + end[1]) / 2), 3)
+                line = [start, middle, end]
+                r = rand.random()
+                if r >= mismatch / 2:
+                    refs = []
+                    for p in line:
+                        if p not in nodes:
+                            nodes[p] = len(nodes) + 1
+                        refs.append(nodes[p])
+                    osm_ways.append(refs)
+                if not (mismatch / 2 <= r < mismatch):
+                    open_data_lines.append([jitter(p, 1) for p in line])
+
+    with open(osm_file, "w") as fp:
+        fp.write("<?xml version='1.0' encoding='UTF-8'?>\n"
+                 "<osm version=\"0.6\" generator=\"benchmark\">\n")
+        for (lon, lat), node_id in sorted(nodes.items(),
+                                          key=lambda item: item[1]):
+            fp.write("<node id=\"{0}\" version=\"1\" lat=\"{1!r}\" "
+                     "lon=\"{2!r}\"/>\n".format(node_id, lat, lon))
+        for way_id, refs in enumerate(osm_ways, 1):
+            fp.write("<way id=\"{0}\" version=\"1\">\n".format(way_id))
+            for ref in refs:
+                fp.write("<nd ref=\"{0}\"/>\n".format(ref))
+            fp.write("<tag k=\"highway\" v=\"residential\"/>\n</way>\n")
+        fp.write("</osm>\n")
+
+    writer = shapefile.Writer(os.path.join(directory, "roads"),
+                              shapeType=shapefile.POLYLINE)
+    writer.field("id", "N", 10)
+    for line_id, line in enumerate(open_data_lines, 1):
+        writer.line([line])
+        writer.record(line_id)
+    writer.close()
+
+    (minx, miny) = point(-0.5, -0.5)
+    (maxx, maxy) = point(n - 0.5, n - 0.5)
+    writer = shapefile.Writer(os.path.join(directory, "boundaries"),
+                              shapeType=shapefile.POLYGON)
+    writer.field("id", "N", 10)
+    writer.poly([[(minx, miny), (minx, maxy), (maxx, maxy), (maxx, miny),
+                  (minx, miny)]])
+    writer.record(1)
+    writer.close()
+    return (len(osm_ways), len(open_data_lines))
+
+
+def main():
+    text = ("Benchmark the analysis and the creation of map data with "
+            "every comparator and output type, on a synthetic road network "
+            "and on the data of the demo project. Wall time, peak memory "
+            "and size of the output files of each stage are written in a "
+            "JSON file.")
+    parser = argparse.ArgumentParser(description=text)
+    parser.add_argument("--ways",
+                        help="approximate number of ways of the synthetic "
+                             "network (default: 2000)",
+                        type=int,
+                        default=2000)
+    parser.add_argument("--mismatch",
+                        help="fraction of ways missing in OSM or in the "
+                             "open data (default: 0.1)",
+                        type=float,
+                        default=0.1)
+    parser.add_argument("--seed",
+                        help="seed of the synthetic network (default: 1)",
+                        type=int,
+                        default=1)
+    parser.add_argument("--comparators",
+                        help="comparators to run (default: {0})".format(
+                            " ".join(COMPARATORS)),
+                        nargs="+",
+                        default=COMPARATORS,
+                        metavar=("COMPARATOR"))
+    parser.add_argument("--outputs",
+                        help="output types to create (default: {0})".format(
+                            " ".join(OUTPUTS)),
+                        nargs="+",
+                        choices=OUTPUTS,
+                        default=OUTPUTS,
+                        metavar=("TYPE"))
+    parser.add_argument("--min_zoom",
+                        help="min zoom of the tiles (default: 10)",
+                        type=int,
+                        default=10)
+    parser.add_argument("--max_zoom",
+                        help="max zoom of the tiles (default: 15)",
+                        type=int,
+                        default=15)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--demo",
+                       help="run also with the data of the demo project "
+                            "(Rimini and Verona). Its OSM data must have "
+                            "been downloaded once",
+                       action="store_true")
+    group.add_argument("--demo_only",
+                       help="run only with the data of the demo project",
+                       action="store_true")
+    parser.add_argument("--postgis_user",
+                        help="PostGIS user, for PostGIS comparators",
+                        default="")
+    parser.add_argument("--postgis_password",
+                        help="PostGIS password, for PostGIS comparators",
+                        default="")
+    parser.add_argument("-d", "--directory",
+                        help="directory of the benchmark projects "
+                             "(default: a new temporary directory)")
+    parser.add_argument("-o", "--output",
+                        help="JSON file with the results (default: "
+                             "benchmark.json in the benchmark directory)")
+    args = parser.parse_args()
+    Benchmark(args).run()
+
+if __name__ == "__main__":
+    main()
@@ -18,7 +18,11 @@
 
 import time
 import os
+import re
 import sys
+import gzip
+import shutil
+from exporter import GeoJSONWriter, ShapefileWriter
 
 
 class Comparator:
@@ -29,20 +33,176 @@ class Comparator:
         # style_points.xml in map rendering
         self.geometry_type = ""
         self.database_type = ""      # "spatialite" OR "postgis"
+        # Tables of OSM and open data ways, counted in the metrics
+        self.ways_tables = ()
+        # Ways read from the sources by create_db() or update_db(), e.g.
+        # {"osm": highways, "open_data": lines}, counted in the metrics
+        self.rows_read = {}
+        # SRID of the buffers: a UTM zone with "tolerance_m"
+        self.srid = 4326
+
+    def set_metric_srid(self, bbox):
+        """With "tolerance_m", choose the UTM zone of the center of bbox
+           (minx, miny, maxx, maxy) as CRS of the buffers.
+        """
+        if self.task.tolerance_m is None:
+            return
+        lon = (bbox[0] + bbox[2]) / 2.0
+        lat = (bbox[1] + bbox[3]) / 2.0
+        zone = min(int((lon + 180) / 6) + 1, 60)
+        if lat >= 0:
+            self.srid = 32600 + zone
+        else:
+            self.srid = 32700 + zone
+        print "- compare in EPSG:{0} with a tolerance of {1} m".format(
+            self.srid, self.task.tolerance_m)
+
+    def to_buffers_crs(self, geometry):
+        """Return the SQL of geometry (WGS84) in the CRS of the buffers.
+        """
+        if self.srid == 4326:
+            return geometry
+        return "ST_Transform({0}, {1})".format(geometry, self.srid)
+
+    def from_buffers_crs(self, geometry):
+        """Return the SQL of geometry (in the CRS of the buffers) in WGS84.
+        """
+        if self.srid == 4326:
+            return geometry
+        return "ST_Transform({0}, 4326)".format(geometry)
+
+    def buffer(self, geometry):
+        """Return the SQL of the buffer around geometry (WGS84), in the CRS
+           of the buffers: 0.0001 degrees or "tolerance_m" meters wide,
+           with "quad_segs" segments per quarter circle.
+        """
+        args = [self.to_buffers_crs(geometry)]
+        if self.task.tolerance_m is None:
+            args.append("0.0001")
+        else:
+            args.append(repr(self.task.tolerance_m))
+        if self.task.quad_segs is not None:
+            args.append(str(self.task.quad_segs))
+        return "ST_Buffer({0})".format(", ".join(args))
 
     def download_osm(self):
-        url = 'http://overpass-api.de/api/interpreter?{0}'.format(
-              self.task.overpass_query)
+        # Extracts of the same query are downloaded once for the TTL of
+        # the cache
+        cache = self.task.osm_cache
+        if cache is not None:
+            key = cache.key("overpass", self.task.overpass_url,
+                            self.task.overpass_query)
+            if cache.get(key, self.task.osm_file_pbf):
+                print "OSM data read from the cache ({0})".format(key)
+                return
+        url = '{0}?{1}'.format(self.task.overpass_url,
+                               self.task.overpass_query)
         cmd = "wget '{0}' -O {1}".format(url, self.task.osm_file)
         self.task.execute("cmd", cmd)
         self.convert_osm_to_pbf(self.task.osm_file, self.task.osm_file_pbf)
+        if cache is not None:
+            cache.put(key, self.task.osm_file_pbf)
 
     def filter_osm(self):
+        # The result of a command is cached until the files it reads
+        # change
+        cache = self.task.osm_cache
+        if cache is not None:
+            sources = []
+            for argument in self.task.osmfilter_command.split():
+                path = os.path.join(self.task.osm_dir, argument)
+                if not argument.startswith("-") and os.path.isfile(path):
+                    sources.append("{0} {1} {2}".format(
+                        argument, os.path.getmtime(path),
+                        os.path.getsize(path)))
+            key = cache.key("osmfilter", self.task.osmfilter_command,
+                            *sources)
+            if cache.get(key, self.task.osm_file_pbf):
+                print "OSM data read from the cache ({0})".format(key)
+                return
         current_dir = os.getcwd()
         os.chdir(self.task.osm_dir)
         self.task.execute("cmd", self.task.osmfilter_command)
         self.convert_osm_to_pbf(self.task.osm_file_o5m, self.task.osm_file_pbf)
         os.chdir(current_dir)
+        if cache is not None:
+            cache.put(key, self.task.osm_file_pbf)
+
+    def read_osm_state(self):
+        """Return the replication sequence number of the OSM extract.
+        """
+        if not os.path.isfile(self.task.osm_state_file):
+            sys.exit("\n* Error: {0} is missing. Write in it the sequence"
+                     " number of the replication diffs that follow the OSM"
+                     " extract, e.g. \"sequenceNumber=1234\", to use"
+                     " --update_osm".format(self.task.osm_state_file))
+        with open(self.task.osm_state_file) as fp:
+            for line in fp:
+                if line.startswith("sequenceNumber="):
+                    return int(line.split("=")[1])
+        sys.exit("\n* Error: sequenceNumber is missing in {0}".format(
+                 self.task.osm_state_file))
+
+    def write_osm_state(self, sequence):
+        with open(self.task.osm_state_file, "w") as fp:
+            fp.write("sequenceNumber={0}\n".format(sequence))
+
+    def find_osm_changes(self):
+        """Return [(sequence, file)] of the change files in osm_changes_dir,
+           sorted by sequence. Both "123.osc" files and the replication
+           layout "000/000/123.osc.gz" are supported.
+        """
+        changes = []
+        for root, dirs, files in os.walk(self.task.osm_changes_dir):
+            for f in files:
+                if not (f.endswith(".osc") or f.endswith(".osc.gz")):
+                    continue
+                path = os.path.join(root, f)
+                relpath = os.path.relpath(path, self.task.osm_changes_dir)
+                digits = re.sub(r"\D", "", relpath.split(".")[0])
+                if digits != "":
+                    changes.append((int(digits), path))
+        return sorted(changes)
+
+    def update_osm(self):
+        """Apply the change files that follow the OSM extract.
+        """
+        sequence = self.read_osm_state()
+        changes = [(n, f) for (n, f) in self.find_osm_changes()
+                   if n > sequence]
+        if not changes:
+            print "OSM data is up to date (sequence {0}).".format(sequence)
+            return
+
+        print "apply {0} change files ({1}-{2})".format(
+            len(changes), changes[0][0], changes[-1][0])
+        osc_files = []
+        # Files decompressed here, removed after being applied
+        decompressed = []
+        for (n, f) in changes:
+            if f.endswith(".gz"):
+                # osmconvert does not read compressed files
+                osc_file = os.path.join(self.task.osm_dir,
+                                        "{0}.osc".format(n))
+                with open(osc_file, "wb") as fp:
+                    shutil.copyfileobj(gzip.open(f), fp)
+                decompressed.append(osc_file)
+            else:
+                osc_file = f
+            osc_files.append(osc_file)
+
+        new_pbf = self.task.osm_file_pbf + ".new"
+        cmd = "osmconvert {0} {1} -o={2}".format(self.task.osm_file_pbf,
+                                                 " ".join(osc_files),
+                                                 new_pbf)
+        self.task.execute("cmd", cmd)
+        if not os.path.isfile(new_pbf):
+            sys.exit("\n* Error: change files cannot be applied to "
+                     "{0}".format(self.task.osm_file_pbf))
+        os.rename(new_pbf, self.task.osm_file_pbf)
+        for osc_file in decompressed:
+            os.remove(osc_file)
+        self.write_osm_state(changes[-1][0])
 
     def convert_osm_to_pbf(self, osm_file, pbf_file):
         cmd = "osmconvert {0} -o={1}".format(osm_file, pbf_file)
@@ -55,7 +215,9 @@ class Comparator:
                 sys.exit("\n*Error: you must specify an Overpass query for "
                          "\"{0}\" task in project.json to use "
                          "--download_osm".format(self.task.name))
-            self.download_osm()
+            with self.task.metrics.stage("download_osm",
+                                         (self.task.osm_file_pbf, )):
+                self.download_osm()
 
         if self.app.args.filter_osm:
             print "\n== Filter OSM data of the task"
@@ -64,7 +226,23 @@ class Comparator:
                          " (\"osmfilter_command\" property) for "
                          "\"{0}\" task in project.json to use "
                          "--filter_osm".format(self.task.name))
-            self.filter_osm()
+            with self.task.metrics.stage("filter_osm",
+                                         (self.task.osm_file_pbf, )):
+                self.filter_osm()
+
+        if self.app.args.update_osm:
+            print "\n== Update OSM data of the task with change files"
+            if self.task.osm_changes_dir == "":
+                sys.exit("\n*Error: you must specify a directory with OSM "
+                         "change files (\"changes_dir\" property) for "
+                         "\"{0}\" task in project.json to use "
+                         "--update_osm".format(self.task.name))
+            if not os.path.isfile(self.task.osm_file_pbf):
+                sys.exit("\n* Error: --update_osm needs an OSM extract to "
+                         "update: {0}".format(self.task.osm_file_pbf))
+            with self.task.metrics.stage("update_osm",
+                                         (self.task.osm_file_pbf, )):
+                self.update_osm()
 
         # Check that OSM data exist
         if not os.path.isfile(self.task.osm_file_pbf):
@@ -79,87 +257,160 @@ class Comparator:
                          "is missing. See \"OpenStreetMap data\" section in "
                          "README.md.")
 
-        print "\n== Create database =="
-        self.create_db()
+        try:
+            if self.task.update:
+                print "\n== Update database of previous analysis =="
+                with self.task.metrics.stage("update_db") as record:
+                    self.update_db()
+                    record["rows_in"] = self.rows_read
+                    record["rows_out"] = self.count_ways()
+            else:
+                print "\n== Create database =="
+                with self.task.metrics.stage("create_db") as record:
+                    self.create_db()
+                    record["rows_in"] = self.rows_read
+                    record["rows_out"] = self.count_ways()
+
+                print ("\n== Calculate differences between OSM/open data"
+                       " ways and their buffers ==")
+                for status in self.task.statuses:
+                    with self.task.metrics.stage(
+                            "compare:{0}".format(status)) as record:
+                        self.compare(status)
+                        record["rows_in"] = self.count_compared(status)
+                        record["rows_out"] = self.count_rows(status)
 
-        print ("\n== Calculate differences between OSM/open data ways"
-               " and their buffers ==")
-        for status in self.task.statuses:
-            self.compare(status)
+            print ("\n== Export analysis' result as GeoJSON and Shapefiles ==")
+            with self.task.metrics.stage(
+                    "export", self.task.output_files()) as record:
+                (record["rows_in"], record["features_out"]) = self.export()
+            self.store_osm_file_state()
 
-        print ("\n== Export analysis' result as GeoJSON and Shapefiles ==")
-        self.export()
+            self.task.analysis_time = time.strftime("%d/%m/%Y")
 
-        self.task.analysis_time = time.strftime("%d/%m/%Y")
+            print "\n== Read bbox and center coordinates of the zone =="
+            self.task.read_boundaries_bbox()
+            self.task.read_boundaries_center()
+        finally:
+            self.task.session.close()
+        self.task.session.print_timings()
+        self.task.metrics.print_stages()
 
-        print "\n== Read bbox and center coordinates of the zone =="
-        self.task.read_boundaries_bbox()
-        self.task.read_boundaries_center()
+    def count_rows(self, table):
+        sql = "SELECT Count(*) FROM {0};".format(table)
+        return self.task.session.query(sql)[0][0]
+
+    def count_ways(self):
+        """Return the number of OSM and open data ways in the database.
+        """
+        return dict([(table, self.count_rows(table))
+                     for table in self.ways_tables])
+
+    def count_compared(self, status):
+        """Return the number of ways compared to find the ways of status:
+           open data ways for "notinosm", OSM ways for "onlyinosm".
+        """
+        if status == "notinosm":
+            table = self.ways_tables[1]
+        else:
+            table = self.ways_tables[0]
+        return self.count_ways()[table]
 
-    def multilines_to_line(self, table_in, table_out):
+    def multilines_to_line(self, table_in, table_out, columns=()):
+        """Convert the MULTILINESTRINGs of table_in to LINESTRINGs.
+           columns are copied from table_in to table_out (e.g. way ids).
+        """
         print ("\n- convert multilinestring to linestring"
                " in table {0}").format(table_in)
+        fields = "".join(["{0}, ".format(c) for c in columns])
+        m_fields = "".join(["m.{0}, ".format(c) for c in columns])
         # Extract MULTILINESTRINGs
         sql = """
-            CREATE TABLE {0}_MULTILINESTRING AS SELECT Geometry
+            CREATE TABLE {0}_MULTILINESTRING AS SELECT {2}Geometry
             FROM {1}
             WHERE GeometryType(Geometry) = 'MULTILINESTRING';""".format(
             table_out,
-            table_in)
+            table_in,
+            fields)
         self.task.execute("spatialite", sql)
+        # Convert MULTILINESTRING to linestring and union with LINESTRINGs.
+        # Elements are extracted in SQL, since the ".elemgeo" command of
+        # spatialite CLI is not available through the session
         sql = """
-            SELECT RecoverGeometryColumn('{0}_MULTILINESTRING', 'Geometry',
-                4326, 'MULTILINESTRING', 'XY');""".format(table_out)
-        self.task.execute("spatialite", sql)
-        # Convert MULTILINESTRING to linestring and union with LINESTRINGs
-        sql = (".elemgeo {0}_MULTILINESTRING Geometry"
-               " {1}_SINGLELINESTRING pk_elem multi_id;").format(table_out,
-                                                                 table_out)
+            CREATE TABLE {0}_SINGLELINESTRING AS
+            WITH RECURSIVE n(i) AS (
+                SELECT 1
+                UNION ALL
+                SELECT i + 1 FROM n
+                WHERE i < (SELECT Max(ST_NumGeometries(Geometry))
+                           FROM {0}_MULTILINESTRING))
+            SELECT {1}ST_GeometryN(m.Geometry, n.i) AS Geometry
+            FROM {0}_MULTILINESTRING AS m, n
+            WHERE n.i <= ST_NumGeometries(m.Geometry);""".format(table_out,
+                                                                 m_fields)
         self.task.execute("spatialite", sql)
         sql = """
             CREATE TABLE {0} AS
-            SELECT Geometry
+            SELECT {2}Geometry
             FROM {0}_SINGLELINESTRING
-            UNION
-            SELECT Geometry
+            UNION ALL
+            SELECT {2}Geometry
             FROM {1} WHERE GeometryType(Geometry) = 'LINESTRING';
-            """.format(table_out, table_in)
+            """.format(table_out, table_in, fields)
         self.task.execute("spatialite", sql)
 
+    def osm_file_state(self):
+        """Return (size, modification time) of the OSM file, which change
+           when it is downloaded, filtered or updated.
+        """
+        return (os.path.getsize(self.task.osm_file_pbf),
+                os.path.getmtime(self.task.osm_file_pbf))
+
+    def store_osm_file_state(self):
+        """Store the state of the OSM file in the database, after a
+           successful analysis, if --incremental uses it.
+        """
+        pass
+
+    def can_update(self):
+        """Return True if the database of a previous analysis can be
+           updated with new data (--incremental), instead of being
+           created again.
+        """
+        return False
+
     def export(self):
         """Export results.
-           If output: "vector":
-           Spatialite --> GeoJSON
-           Spatialite --> Shapefile
+           Each result table is read once, while writing the features in
+           all the formats of the task:
+           database --> GeoJSON
+           database --> Shapefile
+           Return the number of rows read and of exported features.
         """
+        rows_count = 0
+        features = 0
         for i, status in enumerate(self.task.statuses):
             print "status", status
-
-            # Export as GeoJSON
-            cmd = "ogr2ogr -f \"GeoJSON\" \"{0}\" ".format(
-                  self.task.geojson_files[i])
-            if self.database_type == "spatialite":
-                cmd += "{0} -sql \"SELECT Geometry FROM ".format(
-                       self.task.database)
-            elif self.database_type == "postgis":
-                cmd += ("PG:\"host=localhost user={0}"
-                        " dbname={1} password={2}\" \"").format(
-                        self.task.postgis_user, self.task.database,
-                        self.task.postgis_password)
-            cmd += "{0}\"".format(status)
-            self.task.execute("cmd", cmd)
-
-            # Export as Shapefile
-            cmd = "ogr2ogr -f \"ESRI Shapefile\" \"{0}\" ".format(
-                  self.task.shapefiles[i])
-            if self.database_type == "spatialite":
-                cmd += "{0} -sql \"SELECT Geometry FROM ".format(
-                       self.task.database)
-            elif self.database_type == "postgis":
-                cmd += ("PG:\"host=localhost user={0}"
-                        " dbname={1} password={2}\" \"").format(
-                    self.task.postgis_user,
-                    self.task.database,
-                    self.task.postgis_password)
-            cmd += "{0}\"".format(status)
-            self.task.execute("cmd", cmd)
+            writers = []
+            if "GeoJSON" in self.task.export_formats:
+                writers.append(GeoJSONWriter(self.task.geojson_files[i],
+                                             self.task.geojson_sequence,
+                                             self.task.geojson_gzip))
+            if "Shapefile" in self.task.export_formats:
+                writers.append(ShapefileWriter(self.task.shapefiles[i],
+                                               self.geometry_type))
+            sql = ("SELECT {0}(Geometry, {1}) FROM {2} "
+                   "WHERE Geometry IS NOT NULL;").format(
+                self.task.session.geojson_function, self.task.precision,
+                status)
+            for rows in self.task.session.stream(sql):
+                rows_count += len(rows)
+                for row in rows:
+                    for writer in writers:
+                        writer.write(row[0])
+            for writer in writers:
+                writer.close()
+            count = writers[0].count if writers else 0
+            features += count
+            print "{0} features exported".format(count)
+        return (rows_count, features)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from comparator import Comparator
+from osmreader import read_highways
+import sqlite3
+import sys
+
+try:
+    import shapefile
+    from shapely import wkb
+    from shapely.geometry import shape
+    from shapely.ops import transform, unary_union
+    from shapely.prepared import prep
+    from shapely.strtree import STRtree
+except ImportError:
+    sys.exit("\n* Error: Shapely and pyshp are needed by the "
+             "highwaysgeometrymemory comparator. Install them with: "
+             "pip install shapely pyshp")
+
+
+def lines_of(geometry):
+    """Return the LineStrings of a geometry (e.g. of a difference).
+    """
+    if geometry.is_empty:
+        return []
+    if geometry.geom_type == "LineString":
+        return [geometry]
+    if geometry.geom_type in ("MultiLineString", "GeometryCollection"):
+        lines = []
+        for part in geometry.geoms:
+            lines.extend(lines_of(part))
+        return lines
+    return []
+
+
+def utm_transformations(srid):
+    """Return the functions that transform coordinates from WGS84 to
+       the UTM zone srid and back, used by shapely.ops.transform.
+    """
+    try:
+        import pyproj
+    except ImportError:
+        sys.exit("\n* Error: pyproj is needed by the highwaysgeometrymemory "
+                 "comparator with \"tolerance_m\". Install it with: "
+                 "pip install pyproj")
+    if hasattr(pyproj, "Transformer"):
+        forward = pyproj.Transformer.from_crs(4326, srid, always_xy=True)
+        backward = pyproj.Transformer.from_crs(srid, 4326, always_xy=True)
+        return (lambda x, y, z=None: forward.transform(x, y),
+                lambda x, y, z=None: backward.transform(x, y))
+    # pyproj < 2
+    wgs84 = pyproj.Proj(init="epsg:4326")
+    utm = pyproj.Proj(init="epsg:{0}".format(srid))
+    return (lambda x, y, z=None: pyproj.transform(wgs84, utm, x, y),
+            lambda x, y, z=None: pyproj.transform(utm, wgs84, x, y))
+
+
+def read_shapes(path):
+    """Return the geometries of a shapefile, in 2D.
+    """
+    reader = shapefile.Reader(path)
+    geometries = []
+    for shp in reader.iterShapes():
+        if not shp.points:
+            continue
+        geometries.append(transform(lambda x, y, z=None: (x, y),
+                                    shape(shp.__geo_interface__)))
+    return geometries
+
+
+# Module for comparing highways in OSM with highways in open data.
+# The comparison is done in memory with Shapely, without importing the
+# data in a database. Only the results are written in a Spatialite
+# database, read by the export and by the creation of map data.
+# OSM features: highways
+# Open data geometry: LINESTRING or MULTILINESTRING
+# Source: Shapefile
+# Database: Spatialite (results only)
+class Highwaysgeometrymemory(Comparator):
+    def __init__(self, task):
+        Comparator.__init__(self, task)
+        self.name = "highwaysgeometrymemory"
+        self.geometry_type = "lines"
+        self.database_type = "spatialite"
+        # Transformations of coordinates to the UTM zone of the buffers,
+        # with "tolerance_m"
+        self.to_crs = None
+        self.from_crs = None
+        # Ways and buffers, in the CRS of the buffers
+        self.ways = {}
+        self.buffers = {}
+
+    def create_db(self):
+        """Read OSM highways and lines from open data in memory and create
+           the buffers. The database only stores the zone's boundaries.
+        """
+        print "\n- read zone's boundaries_file"
+        boundaries = unary_union(read_shapes(self.task.boundaries_file))
+        # With "tolerance_m", geometries are compared in meters, in the
+        # same UTM zone used by the comparators based on a database
+        self.set_metric_srid(boundaries.bounds)
+        if self.srid != 4326:
+            (self.to_crs, self.from_crs) = utm_transformations(self.srid)
+
+        # InitSpatialMetadata(1) runs in a transaction of its own, so it
+        # cannot be executed in the transaction of a script
+        self.spatialite_function("InitSpatialMetadata(1)")
+        sql = "CREATE TABLE boundaries_file (id INTEGER PRIMARY KEY);"
+        self.task.execute("spatialite", sql)
+        self.spatialite_function("AddGeometryColumn('boundaries_file', "
+                                 "'Geometry', 4326, 'MULTIPOLYGON', 'XY')")
+        self.task.session.executemany(
+            ("INSERT INTO boundaries_file (Geometry) "
+             "VALUES (CastToMultiPolygon(GeomFromWKB(?, 4326)));"),
+            [(sqlite3.Binary(boundaries.wkb), )])
+
+        self.ways["osm_ways"] = self.read_osm_data(boundaries)
+        self.ways["open_data_ways"] = self.read_open_data()
+
+        for table in ("osm_ways", "open_data_ways"):
+            print "\n- create buffers of ", table
+            self.buffers[table] = [self.buffer_of(way)
+                                   for way in self.ways[table]]
+            print "{0} buffers".format(len(self.buffers[table]))
+
+    def spatialite_function(self, function):
+        """Execute a Spatialite function that returns 1 on success.
+        """
+        sql = "SELECT {0};".format(function)
+        print sql
+        if self.task.session.query(sql)[0][0] != 1:
+            sys.exit("\n* Error: {0} failed.".format(sql))
+
+    def count_ways(self):
+        return dict([(table, len(ways))
+                     for table, ways in self.ways.items()])
+
+    def read_osm_data(self, boundaries):
+        """Return OSM highways clipped to the zone's boundaries.
+        """
+        print "\n- read OSM data"
+        ways = []
+        prepared = prep(boundaries)
+
+        def clip(rows):
+            for osm_id, highway, data in rows:
+                way = wkb.loads(data)
+                if prepared.contains(way):
+                    ways.append(self.project(way))
+                elif prepared.intersects(way):
+                    for line in lines_of(way.intersection(boundaries)):
+                        ways.append(self.project(line))
+        count = read_highways(self.task.osm_file_pbf, clip)
+        self.rows_read["osm"] = count
+        print "{0} highways read, {1} ways in the zone".format(count,
+                                                               len(ways))
+        return ways
+
+    def read_open_data(self):
+        """Return the lines of the open data shapefile.
+        """
+        print "\n- read open data"
+        ways = []
+        geometries = read_shapes(self.task.shape_file)
+        self.rows_read["open_data"] = len(geometries)
+        for geometry in geometries:
+            for line in lines_of(geometry):
+                ways.append(self.project(line))
+        print "{0} ways read".format(len(ways))
+        return ways
+
+    def project(self, geometry):
+        if self.to_crs is None:
+            return geometry
+        return transform(self.to_crs, geometry)
+
+    def unproject(self, geometry):
+        if self.to_crs is None:
+            return geometry
+        return transform(self.from_crs, geometry)
+
+    def buffer_of(self, way):
+        """Return the buffer around way: 0.0001 degrees or "tolerance_m"
+           meters wide, with "quad_segs" segments per quarter circle.
+        """
+        if self.task.tolerance_m is None:
+            distance = 0.0001
+        else:
+            distance = self.task.tolerance_m
+        if self.task.quad_segs is None:
+            return way.buffer(distance)
+        return way.buffer(distance, self.task.quad_segs)
+
+    def compared_tables(self, table):
+        """Return the ways and the buffers that must be compared to
+           produce table.
+        """
+        if table == "notinosm":
+            print ("\n- Find ways in zone's data which are missing in OSM"
+                   "\n  (open_data_ways - osm_ways_buffer)")
+            return ("open_data_ways", "osm_ways")
+        elif table == "onlyinosm":
+            print ("\n- Find ways in OSM which are missing in zone's data"
+                   "\n  (osm_ways - open_data_ways_buffer)")
+            return ("osm_ways", "open_data_ways")
+
+    def compare(self, table):
+        """Calculate differences between OSM/open data ways and the buffers
+           of the other ways, found through a STRtree, and write them in
+           table.
+        """
+        (ways, buff) = self.compared_tables(table)
+        buffers = self.buffers[buff]
+        tree = STRtree(buffers)
+        rows = []
+        for way_id, way in enumerate(self.ways[ways], 1):
+            candidates = tree.query(way)
+            # Shapely 2 returns the indices of the geometries
+            if len(candidates) and not hasattr(candidates[0], "geom_type"):
+                candidates = [buffers[i] for i in candidates]
+            prepared = prep(way)
+            candidates = [c for c in candidates if prepared.intersects(c)]
+            if candidates:
+                difference = way.difference(unary_union(candidates))
+            else:
+                difference = way
+            for line in lines_of(difference):
+                rows.append((way_id,
+                             sqlite3.Binary(self.unproject(line).wkb)))
+        print "{0} lines".format(len(rows))
+
+        sql = "CREATE TABLE {0} (way_id INTEGER NOT NULL);".format(table)
+        self.task.execute("spatialite", sql)
+        self.spatialite_function("AddGeometryColumn('{0}', 'Geometry', "
+                                 "4326, 'LINESTRING', 'XY')".format(table))
+        self.task.session.executemany(
+            ("INSERT INTO {0} (way_id, Geometry) "
+             "VALUES (?, GeomFromWKB(?, 4326));").format(table), rows)
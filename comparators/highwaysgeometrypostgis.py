@@ -17,9 +17,56 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from comparator import Comparator
-import os
+from osmreader import read_highways
+import struct
 import sys
 
+# Maximum number of vertices of the pieces of the buffers
+SUBDIVIDE_VERTICES = 64
+
+
+def ewkb(wkb, srid=4326):
+    """Return the EWKB of a WKB geometry, with its SRID, as read by PostGIS
+       in a binary COPY.
+    """
+    if wkb[0] == "\x01":
+        endian = "<"
+    else:
+        endian = ">"
+    geometry_type = struct.unpack(endian + "I", wkb[1:5])[0]
+    if geometry_type & 0x20000000:
+        return wkb
+    return (wkb[0] + struct.pack(endian + "II", geometry_type | 0x20000000,
+                                 srid) + wkb[5:])
+
+
+def linestring_ewkb(points, srid=4326):
+    """Return the EWKB of a 2D linestring.
+    """
+    coordinates = []
+    for point in points:
+        coordinates.extend(point[:2])
+    return (struct.pack("<BIII", 1, 2 | 0x20000000, srid, len(points)) +
+            struct.pack("<{0}d".format(len(coordinates)), *coordinates))
+
+
+def read_shapefile_lines(path):
+    """Yield (gid, EWKB) of the lines of a shapefile, forced to 2D. gid is
+       the number of the record, shared by the parts of a multilinestring.
+    """
+    try:
+        import shapefile
+    except ImportError:
+        sys.exit("\n* Error: pyshp is needed to import the open data in "
+                 "PostGIS. Install it with: pip install pyshp")
+    reader = shapefile.Reader(path)
+    for gid, shape in enumerate(reader.iterShapes(), 1):
+        parts = list(shape.parts) + [len(shape.points)]
+        for i in range(len(parts) - 1):
+            points = shape.points[parts[i]:parts[i + 1]]
+            if len(points) >= 2:
+                yield (gid, buffer(linestring_ewkb(points)))
+
 
 # Module for comparing highways in OSM with highways in open data.
 # OSM features: highways
@@ -32,77 +79,70 @@ class Highwaysgeometrypostgis(Comparator):
         self.name = "highwaysgeometrypostgis"
         self.geometry_type = "lines"
         self.database_type = "postgis"
+        self.ways_tables = ("ways", "open_data_dump")
 
     def create_db(self):
-        """Create a PostGis database with OSM highways
-           and lines from open data.
+        """Create the schema of the task in the PostGIS database, with OSM
+           highways and lines from open data. Both are loaded with a
+           binary COPY and indexed after the load.
         """
         if self.task.postgis_user == "" or self.task.postgis_password == "":
             sys.exit("\n* Error: postgis_user or postgis_password are missing "
                      "in project file")
 
-        print "- Create a new database"
-        self.task.execute("cmd", "dropdb {0} --if-exists".format(
-                          self.task.database))
-        self.task.execute("cmd", "createdb {0}".format(self.task.database))
-
-        self.task.execute("postgis", "CREATE EXTENSION postgis;")
-        self.task.execute("postgis", "CREATE EXTENSION hstore;")
+        print "- Create the schema of the task"
+        self.task.session.create_database()
+        sql = """
+            DROP SCHEMA IF EXISTS {0} CASCADE;
+            CREATE SCHEMA {0};
 
-        self.task.execute("cmd",
-                          ("psql -d {0} -f /usr/share/doc/osmosis/examples/"
-                           "pgsnapshot_schema_0.6.sql").format(
-                           self.task.database))
-        self.task.execute("cmd",
-                          ("psql -d {0} -f /usr/share/doc/osmosis/examples/"
-                           "pgsnapshot_schema_0.6_linestring.sql").format(
-                           self.task.database))
+            CREATE TABLE {0}.ways (
+            id bigint NOT NULL,
+            highway text,
+            linestring geometry(LineString, 4326));
 
-        # Import boundaries
-        """
-        print "\n- import zone's boundaries into database"
-        cmd = ("spatialite_tool -i -shp {0} -d {1}"
-               " -t boundaries -c UTF-8 -s 4326").format(self.task.boundaries,
-                                                         self.task.database)
-        self.task.execute("cmd", cmd)
-        sql = "SELECT CreateSpatialIndex('boundaries', 'Geometry');"
-        self.task.execute("sql", sql)"""
+            CREATE TABLE {0}.open_data_dump (
+            gid bigint NOT NULL,
+            Geometry geometry(LineString, 4326));""".format(self.task.schema)
+        self.task.execute("postgis", sql)
 
         # Import OSM data
         print "\n- import OSM data into database"
-        self.task.execute("cmd",
-                          ("osmosis --rb {0} --wp database={1} "
-                           "user={2} password={3}").format(
-                           self.task.osm_file_pbf, self.task.database,
-                           self.task.postgis_user, self.task.postgis_password))
+
+        def copy(rows):
+            self.task.session.copy(
+                "ways", ("id", "highway", "linestring"),
+                [(osm_id, highway, buffer(ewkb(wkb)))
+                 for osm_id, highway, wkb in rows])
+        count = read_highways(self.task.osm_file_pbf, copy, batch_size=50000)
+        self.rows_read["osm"] = count
+        print "{0} highways imported".format(count)
 
         # Import open data
         print "\n- import open data into database"
-        sql_file = self.task.shape_file + ".sql"
-        if os.path.isfile(sql_file):
-            self.task.execute("cmd", "rm {0}".format(sql_file))
-        self.task.execute("cmd",
-                          ("shp2pgsql -s 4326 -W 'LATIN1' {0}.shp open_data "
-                           "{1} > {2}").format(self.task.shape_file,
-                                               self.task.database,
-                                               sql_file))
-
-        self.task.execute("cmd", "psql -d {0} -f {1}".format(
-                          self.task.database,
-                          sql_file))
-        sql = """
-            DROP TABLE IF EXISTS open_data_dump;
+        self.rows_read["open_data"] = self.task.session.copy(
+            "open_data_dump", ("gid", "Geometry"),
+            read_shapefile_lines(self.task.shape_file))
 
-            CREATE TABLE open_data_dump AS
-            SELECT open_data.gid AS gid,
-            (ST_Dump(ST_Force2d(open_data.geom))).geom AS Geometry
-            FROM open_data;
+        sql = """
+            CREATE INDEX ON ways USING GIST (linestring);
+            CREATE INDEX ON ways (id);
             CREATE INDEX ON open_data_dump USING GIST (Geometry);
             CREATE INDEX ON open_data_dump (gid);
+            VACUUM ANALYZE ways;
             VACUUM ANALYZE open_data_dump;"""
         self.task.execute("postgis", sql)
 
-        # Create buffers around OSM and open data ways
+        sql = """
+            SELECT ST_XMin(extent), ST_YMin(extent),
+            ST_XMax(extent), ST_YMax(extent)
+            FROM (SELECT ST_Extent(Geometry) AS extent
+                  FROM open_data_dump) AS e;"""
+        self.set_metric_srid(self.task.session.query(sql)[0])
+
+        # Create buffers around OSM and open data ways. Buffers are
+        # subdivided, so that only the small pieces near a way are found
+        # through the index and merged by compare()
         for ways in ("ways", "open_data_dump"):
             print "\n- create buffers of ", ways
             if ways == "ways":
@@ -113,13 +153,14 @@ class Highwaysgeometrypostgis(Comparator):
                 DROP TABLE IF EXISTS {ways}_buffer;
 
                 CREATE TABLE {ways}_buffer AS
-                SELECT ST_Buffer({geometry}, 0.0001) AS Geometry
+                SELECT ST_Subdivide({buffer}, {vertices}) AS Geometry
                 FROM {ways}
-                WHERE ST_Buffer({geometry}, 0.0001) IS NOT NULL;
+                WHERE {buffer} IS NOT NULL;
 
                 CREATE INDEX ON {ways}_buffer USING GIST (Geometry);
-                VACUUM ANALYZE {ways}_buffer;""".format(ways=ways,
-                                                        geometry=geometry)
+                VACUUM ANALYZE {ways}_buffer;""".format(
+                ways=ways, buffer=self.buffer(geometry),
+                vertices=SUBDIVIDE_VERTICES)
             self.task.execute("postgis", sql)
 
     def compare(self, table):
@@ -139,38 +180,40 @@ class Highwaysgeometrypostgis(Comparator):
             ways_geometry = "linestring"
             buff = "open_data_dump_buffer"
 
-        sql = """
-            DROP TABLE IF EXISTS {ways}_intersecting, {table};
-
-            -- Create a table with ways intersecting buffers
-            CREATE TABLE {ways}_intersecting AS
-              SELECT DISTINCT ways.{ways_id} AS id,
-                              ways.{ways_geometry} AS Geometry
-              FROM {ways} AS ways, {buff} AS buff
-              WHERE ST_Intersects(ways.{ways_geometry}, buff.Geometry);
-
-            CREATE INDEX ON {ways}_intersecting USING GIST (Geometry);
-            CREATE INDEX ON {ways}_intersecting (id);
-            VACUUM ANALYZE {ways}_intersecting;
-
-            CREATE TABLE {table} AS (
-              -- Difference between ways intersecating buffers and buffers
-              SELECT (ST_Dump(ST_Difference(ways.Geometry,
-                      ST_Union(buff.Geometry)))).geom AS Geometry
-              FROM {ways}_intersecting AS ways, {buff} AS buff
-              WHERE ST_Intersects(ways.Geometry, buff.Geometry)
-              GROUP BY ways.Geometry
-            UNION
-              -- Add non intersecating ways
-              SELECT ways.{ways_geometry} AS Geometry
-              FROM {ways} AS ways
-              LEFT OUTER JOIN {ways}_intersecting
-              ON ways.{ways_id} = {ways}_intersecting.id
-              WHERE {ways}_intersecting.id IS NULL);""".format(
+        # Queries of the difference of each way can be run by parallel
+        # workers
+        sql = ""
+        if self.task.parallel_workers is not None:
+            sql = "SET max_parallel_workers_per_gather = {0};".format(
+                self.task.parallel_workers)
+
+        # For each way, the pieces of buffers that intersect it are found
+        # through the index and merged, in a LATERAL subquery. Ways that
+        # do not intersect any buffer are kept as they are
+        sql += """
+            DROP TABLE IF EXISTS {table};
+
+            CREATE TABLE {table} AS
+            SELECT ways.{ways_id} AS way_id,
+            (ST_Dump(CASE WHEN buffers.Geometry IS NULL
+                          THEN ways.{ways_geometry}
+                          ELSE {difference} END)).geom AS Geometry
+            FROM {ways} AS ways
+            CROSS JOIN LATERAL (
+                SELECT {projected} AS Geometry) AS way
+            CROSS JOIN LATERAL (
+                SELECT ST_Union(buff.Geometry) AS Geometry
+                FROM {buff} AS buff
+                WHERE ST_Intersects(way.Geometry, buff.Geometry)
+                ) AS buffers;""".format(
             table=table,
             ways=ways,
             ways_id=ways_id,
             ways_geometry=ways_geometry,
-            buff=buff)
+            buff=buff,
+            projected=self.to_buffers_crs(
+                "ways.{0}".format(ways_geometry)),
+            difference=self.from_buffers_crs(
+                "ST_Difference(way.Geometry, buffers.Geometry)"))
 
         self.task.execute("postgis", sql)
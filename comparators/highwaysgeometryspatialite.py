@@ -17,8 +17,64 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from comparator import Comparator
-import os
-import sys
+from database import connect_spatialite
+from osmreader import read_highways
+from segments import LocalProjection, heading, split_line, merge_runs, \
+    linestring_wkt
+import json
+import math
+from multiprocessing import Pool, current_process
+import sqlite3
+
+
+def compare_tile(args):
+    """Calculate the differences between the ways clipped to a tile
+       and the buffers that intersect them. to_buffers_crs and
+       from_buffers_crs are templates of the SQL transformations between
+       WGS84 and the CRS of the buffers.
+       Executed by worker processes, with their own database connection.
+       Return a list of (way ROWID, WKB geometry).
+    """
+    (database, ways, buff, (minx, miny, maxx, maxy),
+     to_buffers_crs, from_buffers_crs) = args
+    tile = "BuildMbr({0}, {1}, {2}, {3}, 4326)".format(minx, miny,
+                                                       maxx, maxy)
+    sql = """
+        SELECT id, AsBinary({result})
+        FROM (
+            SELECT clip.id AS id, clip.Geometry AS Geometry,
+            (SELECT ST_Union(buffer.Geometry)
+             FROM {buff} AS buffer
+             WHERE ST_Intersects(clip.Geometry, buffer.Geometry)
+             AND buffer.ROWID IN (
+                SELECT ROWID
+                FROM SpatialIndex
+                WHERE f_table_name = '{buff}'
+                AND search_frame = clip.Geometry)) AS buffers
+            FROM (
+                SELECT way.ROWID AS id,
+                {clip} AS Geometry
+                FROM {ways} AS way
+                WHERE way.ROWID IN (
+                    SELECT ROWID
+                    FROM SpatialIndex
+                    WHERE f_table_name = '{ways}'
+                    AND search_frame = {tile})) AS clip
+            WHERE clip.Geometry IS NOT NULL);""".format(
+        ways=ways, buff=buff, tile=tile,
+        clip=to_buffers_crs.format(
+            "CollectionExtract(ST_Intersection(way.Geometry, {0}), "
+            "2)".format(tile)),
+        result=from_buffers_crs.format(
+            "CASE WHEN buffers IS NULL THEN Geometry "
+            "ELSE ST_Difference(Geometry, buffers) END"))
+    connection = connect_spatialite(database)
+    # Ways completely covered by buffers have a NULL difference.
+    # buffer objects cannot be pickled
+    rows = [(row[0], str(row[1])) for row in connection.execute(sql)
+            if row[1] is not None]
+    connection.close()
+    return rows
 
 
 # Module for comparing highways in OSM with highways in open data.
@@ -32,14 +88,12 @@ class Highwaysgeometryspatialite(Comparator):
         self.name = "highwaysgeometryspatialite"
         self.geometry_type = "lines"
         self.database_type = "spatialite"
+        self.ways_tables = ("osm_ways", "open_data_ways")
 
     def create_db(self):
         """Create a Spatialite database with OSM highways
            and lines from open data.
         """
-        print "- Remove data produced by previous executions of the script"
-        self.task.execute("cmd", "rm {0}/li*".format(self.task.osm_dir))
-
         # Import boundaries_file
         print "\n- import zone's boundaries_file into database"
         cmd = ("spatialite_tool -i -shp {0} -d {1}"
@@ -49,116 +103,646 @@ class Highwaysgeometryspatialite(Comparator):
         self.task.execute("cmd", cmd)
         sql = "SELECT CreateSpatialIndex('boundaries_file', 'Geometry');"
         self.task.execute("spatialite", sql)
+        self.set_metric_srid(self.read_boundaries_extent())
+
+        self.import_osm_data("osm_ways")
+        self.import_open_data("open_data_ways")
+
+        # Create spatial indexes and buffers around OSM/open data ways
+        for table in ("osm_ways", "open_data_ways"):
+
+            print "\n- create spatial index of ", table
+            sql = "SELECT CreateSpatialIndex('{0}', 'Geometry');".format(table)
+            self.task.execute("spatialite", sql)
+
+            if self.task.comparison == "segments":
+                self.create_segments(table)
+                continue
+
+            print "\n- create buffers of ", table
+            # Buffers reference their way, so that they can be updated
+            # with --incremental
+            sql = """
+                CREATE TABLE {0}_buffer AS
+                {1};
+                CREATE INDEX {0}_buffer_way_id ON {0}_buffer (way_id);
+                """.format(table, self.buffers_sql(table))
+            self.task.execute("spatialite", sql)
+            sql = """
+                SELECT RecoverGeometryColumn('{0}_buffer', 'Geometry',
+                {1}, 'POLYGON', 'XY');""".format(table, self.srid)
+            self.task.execute("spatialite", sql)
+            sql = ("SELECT CreateSpatialIndex('{0}_buffer', "
+                   "'Geometry');").format(table)
+            self.task.execute("spatialite", sql)
+
+    def create_segments(self, table):
+        """Split the ways of table in short segments, with coordinates in
+           meters of a local projection, and index them in a R*Tree.
+        """
+        print "\n- split the ways of ", table, "in segments"
+        sql = """
+            CREATE TABLE {0}_segments (
+            id INTEGER PRIMARY KEY,
+            way_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            lon0 REAL, lat0 REAL, lon1 REAL, lat1 REAL,
+            x0 REAL, y0 REAL, dx REAL, dy REAL, len2 REAL,
+            mx REAL, my REAL, heading REAL);
+            CREATE VIRTUAL TABLE {0}_segments_index
+            USING rtree(id, minx, maxx, miny, maxy);""".format(table)
+        self.task.execute("spatialite", sql)
+
+        (minx, miny, maxx, maxy) = self.read_boundaries_extent()
+        projection = LocalProjection((miny + maxy) / 2.0)
+        sql = "SELECT ROWID, AsGeoJSON(Geometry, 9) FROM {0};".format(table)
+        ways = self.task.session.query(sql)
+        segments = []
+        count = 0
+        for (way_id, geojson) in ways:
+            if geojson is None:
+                continue
+            points = json.loads(geojson)["coordinates"]
+            for seq, (lon0, lat0, lon1, lat1, x0, y0, x1, y1) in enumerate(
+                    split_line(points, self.task.segment_length, projection)):
+                segments.append((way_id, seq, lon0, lat0, lon1, lat1,
+                                 x0, y0, x1 - x0, y1 - y0,
+                                 (x1 - x0) ** 2 + (y1 - y0) ** 2,
+                                 (x0 + x1) / 2.0, (y0 + y1) / 2.0,
+                                 heading(x0, y0, x1, y1)))
+            if len(segments) >= 10000:
+                count += self.insert_segments(table, segments)
+                segments = []
+        count += self.insert_segments(table, segments)
+        print "{0} segments".format(count)
+
+        sql = """
+            INSERT INTO {0}_segments_index (id, minx, maxx, miny, maxy)
+            SELECT id, Min(x0, x0 + dx), Max(x0, x0 + dx),
+            Min(y0, y0 + dy), Max(y0, y0 + dy)
+            FROM {0}_segments;
+            CREATE INDEX {0}_segments_way_id
+            ON {0}_segments (way_id, seq);""".format(table)
+        self.task.execute("spatialite", sql)
 
-        # Import OSM data
+    def insert_segments(self, table, segments):
+        self.task.session.executemany(
+            ("INSERT INTO {0}_segments (way_id, seq, lon0, lat0, lon1, "
+             "lat1, x0, y0, dx, dy, len2, mx, my, heading) VALUES "
+             "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);").format(table),
+            segments)
+        return len(segments)
+
+    def read_boundaries_extent(self):
+        """Return (minx, miny, maxx, maxy) of the zone's boundaries.
+        """
+        sql = """
+            SELECT Min(MbrMinX(Geometry)), Min(MbrMinY(Geometry)),
+            Max(MbrMaxX(Geometry)), Max(MbrMaxY(Geometry))
+            FROM boundaries_file;"""
+        return self.task.session.query(sql)[0]
+
+    def import_osm_data(self, table):
+        """Import OSM highways in table, clipped to the zone's boundaries.
+        """
         print "\n- import OSM data into database"
-        cmd = ("ogr2ogr -f \"ESRI Shapefile\" {0} {1}"
-               " -sql \"SELECT osm_id FROM lines\""
-               " -lco SHPT=ARC").format(self.task.osm_dir,
-                                        self.task.osm_file_pbf)
-        self.task.execute("cmd", cmd)
+        sql = """
+            CREATE TABLE raw_osm_ways (
+            osm_id INTEGER NOT NULL,
+            highway TEXT);
+            SELECT AddGeometryColumn('raw_osm_ways', 'Geometry',
+            4326, 'LINESTRING', 'XY');"""
+        self.task.execute("spatialite", sql)
 
-        cmd = ("spatialite_tool -i -shp {0} -d {1}"
-               " -t raw_osm_ways -c UTF-8 -s 4326").format(
-            os.path.join(self.task.osm_dir, "lines"),
-            self.task.database)
-        self.task.execute("cmd", cmd)
+        def insert(rows):
+            self.task.session.executemany(
+                ("INSERT INTO raw_osm_ways (osm_id, highway, Geometry) "
+                 "VALUES (?, ?, GeomFromWKB(?, 4326));"),
+                [(osm_id, highway, sqlite3.Binary(wkb))
+                 for osm_id, highway, wkb in rows])
+        count = read_highways(self.task.osm_file_pbf, insert)
+        self.rows_read["osm"] = count
+        print "{0} highways imported".format(count)
 
         print ("\n- extract highways in OSM that intersect zone's "
                "boundaries_file")
+        if not self.task.session.query(
+                "SELECT name FROM sqlite_master "
+                "WHERE name = 'boundaries_pieces';"):
+            self.subdivide_boundaries()
+        # Ways contained in a piece of the boundaries are kept as they
+        # are. The other ones are clipped to the pieces they intersect
         sql = """
-            CREATE TABLE osm_ways_MIXED AS
-            SELECT ST_Intersection(b.Geometry, w.Geometry) AS Geometry
-            FROM boundaries_file AS b, raw_osm_ways AS w;"""
+            CREATE TABLE raw_osm_ways_inside AS
+            SELECT w.ROWID AS id
+            FROM raw_osm_ways AS w
+            WHERE EXISTS (
+                SELECT 1
+                FROM boundaries_pieces AS p
+                WHERE p.ROWID IN (
+                    SELECT ROWID
+                    FROM SpatialIndex
+                    WHERE f_table_name = 'boundaries_pieces'
+                    AND search_frame = w.Geometry)
+                AND ST_Contains(p.Geometry, w.Geometry));
+            CREATE INDEX raw_osm_ways_inside_id ON raw_osm_ways_inside (id);
+
+            CREATE TABLE {0}_MIXED AS
+            SELECT w.Geometry AS Geometry
+            FROM raw_osm_ways AS w
+            WHERE w.ROWID IN (SELECT id FROM raw_osm_ways_inside);
+
+            INSERT INTO {0}_MIXED (Geometry)
+            SELECT ST_Intersection(w.Geometry, ST_Union(p.Geometry))
+            FROM raw_osm_ways AS w, boundaries_pieces AS p
+            WHERE w.ROWID NOT IN (SELECT id FROM raw_osm_ways_inside)
+            AND p.ROWID IN (
+                SELECT ROWID
+                FROM SpatialIndex
+                WHERE f_table_name = 'boundaries_pieces'
+                AND search_frame = w.Geometry)
+            AND ST_Intersects(p.Geometry, w.Geometry)
+            GROUP BY w.ROWID;
+
+            DROP TABLE raw_osm_ways_inside;""".format(table)
         self.task.execute("spatialite", sql)
 
-        self.multilines_to_line("osm_ways_MIXED", "osm_ways")
+        self.multilines_to_line("{0}_MIXED".format(table), table)
+        self.add_hash(table)
+
+    def subdivide_boundaries(self):
+        """Split the boundaries in the cells of a grid, so that ways are
+           compared with small, indexed pieces of them instead of with the
+           whole detailed polygon. The grid is finer for boundaries with
+           more vertices.
+        """
+        print "\n- subdivide zone's boundaries_file"
+        (minx, miny, maxx, maxy) = self.read_boundaries_extent()
+        vertices = self.task.session.query(
+            "SELECT Sum(ST_NPoints(Geometry)) FROM boundaries_file;")[0][0]
+        n = min(max(int(math.ceil((vertices or 0) / 256.0)), 1), 64)
+        # Cells are slightly larger than needed, so that the boundaries
+        # are entirely covered despite rounding
+        margin = max(maxx - minx, maxy - miny) * 1e-9
+        width = (maxx - minx) / n
+        height = (maxy - miny) / n
+        cells = []
+        for i in range(n):
+            for j in range(n):
+                cells.append((minx + i * width - margin,
+                              miny + j * height - margin,
+                              minx + (i + 1) * width + margin,
+                              miny + (j + 1) * height + margin))
         sql = """
-            SELECT RecoverGeometryColumn('osm_ways', 'Geometry',
-            4326, 'LINESTRING', 'XY');"""
+            CREATE TABLE boundaries_cells (
+            minx REAL, miny REAL, maxx REAL, maxy REAL);"""
         self.task.execute("spatialite", sql)
+        self.task.session.executemany(
+            "INSERT INTO boundaries_cells VALUES (?, ?, ?, ?);", cells)
+        sql = """
+            CREATE TABLE boundaries_pieces AS
+            SELECT Geometry FROM (
+                SELECT CastToMultiPolygon(CollectionExtract(
+                    ST_Intersection(b.Geometry, BuildMbr(
+                        c.minx, c.miny, c.maxx, c.maxy, 4326)),
+                    3)) AS Geometry
+                FROM boundaries_file AS b, boundaries_cells AS c
+                WHERE MbrIntersects(b.Geometry, BuildMbr(
+                    c.minx, c.miny, c.maxx, c.maxy, 4326)))
+            WHERE Geometry IS NOT NULL;
+            DROP TABLE boundaries_cells;
+            SELECT RecoverGeometryColumn('boundaries_pieces', 'Geometry',
+            4326, 'MULTIPOLYGON', 'XY');
+            SELECT CreateSpatialIndex('boundaries_pieces', 'Geometry');"""
+        self.task.execute("spatialite", sql)
+        count = self.task.session.query(
+            "SELECT Count(*) FROM boundaries_pieces;")[0][0]
+        print "{0} vertices, {1} pieces".format(vertices, count)
 
-        # Import open data
+    def import_open_data(self, table):
+        """Import the ways of the open data shapefile in table.
+        """
         print "\n- import open data"
         cmd = ("spatialite_tool -2 -i -shp {0} -d {1}"
-               " -t open_data_ways_MIXED -c CP1252 -s 4326").format(
+               " -t {2}_MIXED -c CP1252 -s 4326").format(
                self.task.shape_file,
-               self.task.database)
+               self.task.database,
+               table)
         self.task.execute("cmd", cmd)
+        self.rows_read["open_data"] = self.count_rows(
+            "{0}_MIXED".format(table))
 
-        self.multilines_to_line("open_data_ways_MIXED", "open_data_ways")
+        self.multilines_to_line("{0}_MIXED".format(table), table)
+        self.add_hash(table)
+
+    def add_hash(self, table):
+        """Register the geometry column of a ways table and add the hash of
+           the geometries, used by --incremental to find changed ways.
+        """
         sql = """
-            SELECT RecoverGeometryColumn('open_data_ways', 'Geometry',
-            4326, 'LINESTRING', 'XY');"""
+            SELECT RecoverGeometryColumn('{0}', 'Geometry',
+            4326, 'LINESTRING', 'XY');
+            ALTER TABLE {0} ADD COLUMN hash TEXT;
+            UPDATE {0} SET hash = MD5Checksum(Geometry);
+            CREATE INDEX {0}_hash ON {0} (hash);""".format(table)
         self.task.execute("spatialite", sql)
 
-        # Create spatial indexes and buffers around OSM/open data ways
-        for table in ("osm_ways", "open_data_ways"):
-
-            print "\n- create spatial index of ", table
-            sql = "SELECT CreateSpatialIndex('{0}', 'Geometry');".format(table)
-            self.task.execute("spatialite", sql)
-
-            print "\n- create buffers of ", table
-            sql = """
-                CREATE TABLE {0}_buffer AS
-                SELECT ST_Buffer(Geometry, 0.0001) AS Geometry
-                FROM {0}
-                WHERE ST_Buffer(Geometry, 0.0001) NOT NULL;""".format(table)
-            self.task.execute("spatialite", sql)
-            sql = """
-                SELECT RecoverGeometryColumn('{0}_buffer', 'Geometry',
-                4326, 'POLYGON', 'XY');""".format(table)
-            self.task.execute("spatialite", sql)
-            sql = ("SELECT CreateSpatialIndex('{0}_buffer', "
-                   "'Geometry');").format(table)
-            self.task.execute("spatialite", sql)
+    def buffers_sql(self, table, where="1"):
+        """Return the query of the buffers around the ways of table.
+        """
+        return """
+            SELECT ROWID AS way_id, {0} AS Geometry
+            FROM {1}
+            WHERE {2} AND {0} NOT NULL""".format(
+            self.buffer("Geometry"), table, where)
 
-    def compare(self, table):
-        """Calculate differences between OSM/open data ways and their buffers
+    def compared_tables(self, table):
+        """Return the ways and the buffers that must be compared to
+           produce table.
         """
         if table == "notinosm":
             print ("\n- Find ways in zone's data which are missing in OSM"
                    "\n  (open_data_ways - osm_ways_buffer)")
-            ways = "open_data_ways"
-            buff = "osm_ways_buffer"
+            return ("open_data_ways", "osm_ways_buffer")
         elif table == "onlyinosm":
             print ("\n- Find ways in OSM which are missing in zone's data"
                    "\n  (osm_ways - open_data_ways_buffer)")
-            ways = "osm_ways"
-            buff = "open_data_ways_buffer"
+            return ("osm_ways", "open_data_ways_buffer")
 
+    def compare(self, table):
+        """Calculate differences between OSM/open data ways and their buffers
+        """
+        (ways, buff) = self.compared_tables(table)
+        if self.task.comparison == "segments":
+            self.find_unmatched_segments(table, ways,
+                                         buff.replace("_buffer", ""))
+        else:
+            self.find_differences(table, ways, buff)
         sql = """
-        CREATE TABLE {temptable}_MIXED AS
-        SELECT Geometry FROM (
-            SELECT
-            ST_Difference(way.Geometry, ST_Union(buffer.Geometry)) AS Geometry
-            FROM {ways} AS way, {buff} AS buffer
-            WHERE ST_Intersects(way.Geometry, buffer.Geometry) AND
-            buffer.ROWID IN (
-                    SELECT ROWID
-                    FROM SpatialIndex
-                    WHERE f_table_name = '{buff}'
-                    AND search_frame = way.Geometry)
-            GROUP BY way.Geometry)
-        WHERE Geometry IS NOT NULL
-        UNION
-        SELECT way.Geometry AS Geometry
-        FROM {ways} AS way
-        WHERE way.Geometry NOT IN
-            (SELECT way.Geometry
-            FROM {ways} AS way, {buff} AS buffer
-            WHERE ST_Intersects(way.Geometry, buffer.Geometry)
-            AND buffer.ROWID IN (
+            SELECT RecoverGeometryColumn('{0}', 'Geometry',
+            4326, 'LINESTRING', 'XY');""".format(table)
+        self.task.execute("spatialite", sql)
+
+    def find_differences(self, table, ways, buff, subset=""):
+        """Create table with the parts of ways outside buff and the id of
+           their way. If subset is the name of a table with a way_id
+           column, only those ways are compared.
+        """
+        if subset == "":
+            where = "1"
+        else:
+            where = "way.ROWID IN (SELECT way_id FROM {0})".format(subset)
+
+        # With "tolerance_m" the compared ways are transformed once in the
+        # CRS of the buffers
+        if self.srid == 4326:
+            compared = ways
+            way_id = "way.ROWID"
+            compared_where = where
+            sql = ""
+        else:
+            compared = "{0}_projected".format(ways)
+            way_id = "way.way_id"
+            compared_where = "1"
+            sql = """
+            DROP TABLE IF EXISTS {compared};
+            CREATE TABLE {compared} AS
+            SELECT way.ROWID AS way_id, {geometry} AS Geometry
+            FROM {ways} AS way
+            WHERE {where};
+            CREATE INDEX {compared}_way_id ON {compared} (way_id);
+            """.format(compared=compared, ways=ways, where=where,
+                       geometry=self.to_buffers_crs("way.Geometry"))
+
+        # Ways intersecting buffers are found once, through the spatial
+        # index, and referenced by id by both parts of the result
+        sql += """
+        DROP TABLE IF EXISTS {ways}_intersecting;
+        CREATE TABLE {ways}_intersecting AS
+        SELECT {way_id} AS way_id, buffer.ROWID AS buffer_id
+        FROM {compared} AS way, {buff} AS buffer
+        WHERE {compared_where}
+        AND buffer.ROWID IN (
                 SELECT ROWID
                 FROM SpatialIndex
                 WHERE f_table_name = '{buff}'
-                AND search_frame = way.Geometry));
-        """.format(temptable=table, ways=ways, buff=buff)
+                AND search_frame = way.Geometry)
+        AND ST_Intersects(way.Geometry, buffer.Geometry);
+
+        CREATE INDEX {ways}_intersecting_way_id
+        ON {ways}_intersecting (way_id);
+
+        -- Difference between ways intersecting buffers and buffers
+        CREATE TABLE {table}_MIXED AS
+        SELECT way_id, Geometry FROM (
+            SELECT i.way_id AS way_id,
+            {difference} AS Geometry
+            FROM {ways}_intersecting AS i
+            JOIN {compared} AS way ON {way_id} = i.way_id
+            JOIN {buff} AS buffer ON buffer.ROWID = i.buffer_id
+            GROUP BY i.way_id)
+        WHERE Geometry IS NOT NULL;
+
+        -- Add non intersecting ways
+        INSERT INTO {table}_MIXED (way_id, Geometry)
+        SELECT way.ROWID, way.Geometry
+        FROM {ways} AS way
+        LEFT OUTER JOIN {ways}_intersecting AS i
+        ON way.ROWID = i.way_id
+        WHERE {where} AND i.way_id IS NULL;
+        """.format(table=table, ways=ways, buff=buff, where=where,
+                   compared=compared, compared_where=compared_where,
+                   way_id=way_id,
+                   difference=self.from_buffers_crs(
+                       "ST_Difference(way.Geometry, "
+                       "ST_Union(buffer.Geometry))"))
+        if self.task.grid > 1 and subset == "":
+            self.compare_tiles(table, ways, buff)
+        else:
+            self.task.execute("spatialite", sql)
+
+        self.multilines_to_line("{0}_MIXED".format(table), table,
+                                ("way_id", ))
+
+    def find_unmatched_segments(self, table, ways, other):
+        """Create table with the runs of segments of ways that have no
+           segment of other within the tolerance and with a similar
+           heading. Distances are measured from the middle of a segment to
+           the candidate segments found in the R*Tree of other.
+        """
+        tolerance = self.task.tolerance_m
+        if tolerance is None:
+            tolerance = 10.0
+        # Position of the projection of the middle of s on o, clamped to
+        # the segment
+        t = ("(CASE WHEN o.len2 = 0 THEN 0 ELSE Max(0, Min(1, "
+             "((s.mx - o.x0) * o.dx + (s.my - o.y0) * o.dy) / o.len2)) "
+             "END)")
+        sql = """
+            CREATE TABLE {ways}_unmatched AS
+            SELECT s.id AS id
+            FROM {ways}_segments AS s
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM {other}_segments_index AS i
+                JOIN {other}_segments AS o ON o.id = i.id
+                WHERE i.maxx >= s.mx - {tol} AND i.minx <= s.mx + {tol}
+                AND i.maxy >= s.my - {tol} AND i.miny <= s.my + {tol}
+                AND Min(Abs(s.heading - o.heading),
+                        180 - Abs(s.heading - o.heading)) <= {angle}
+                AND (s.mx - o.x0 - {t} * o.dx) * (s.mx - o.x0 - {t} * o.dx)
+                    + (s.my - o.y0 - {t} * o.dy) * (s.my - o.y0 - {t} * o.dy)
+                    <= {tol2});""".format(
+            ways=ways, other=other, t=t, tol=tolerance,
+            tol2=tolerance * tolerance, angle=self.task.max_angle)
         self.task.execute("spatialite", sql)
 
-        self.multilines_to_line("{0}_MIXED".format(table), table)
+        # Consecutive unmatched segments of a way are merged in lines
         sql = """
-            SELECT RecoverGeometryColumn('{0}', 'Geometry',
-            4326, 'LINESTRING', 'XY');""".format(table)
+            SELECT s.way_id, s.seq, s.lon0, s.lat0, s.lon1, s.lat1
+            FROM {0}_segments AS s
+            JOIN {0}_unmatched AS u ON u.id = s.id
+            ORDER BY s.way_id, s.seq;""".format(ways)
+        lines = [(way_id, linestring_wkt(points)) for (way_id, points)
+                 in merge_runs(self.task.session.query(sql))]
+        print "{0} lines".format(len(lines))
+        sql = """
+            DROP TABLE IF EXISTS {0}_unmatched;
+            CREATE TABLE {1} (
+            way_id INTEGER NOT NULL,
+            Geometry BLOB NOT NULL);""".format(ways, table)
+        self.task.execute("spatialite", sql)
+        self.task.session.executemany(
+            ("INSERT INTO {0} (way_id, Geometry) "
+             "VALUES (?, GeomFromText(?, 4326));").format(table), lines)
+
+    def compare_tiles(self, table, ways, buff):
+        """Split the zone in a grid of tiles and compare the ways of each
+           tile in parallel. Ways are clipped to the tiles, while buffers
+           are not, so the pieces of a way can be merged again without
+           seams.
+        """
+        # The grid covers the boundaries and the compared ways, since open
+        # data ways are not clipped to the boundaries
+        sql = """
+            SELECT Min(MbrMinX(Geometry)), Min(MbrMinY(Geometry)),
+            Max(MbrMaxX(Geometry)), Max(MbrMaxY(Geometry))
+            FROM (SELECT Geometry FROM boundaries_file
+                  UNION ALL
+                  SELECT Geometry FROM {0});""".format(ways)
+        (minx, miny, maxx, maxy) = self.task.session.query(sql)[0]
+        grid = self.task.grid
+        width = (maxx - minx) / grid
+        height = (maxy - miny) / grid
+        tiles = []
+        for i in range(grid):
+            for j in range(grid):
+                tiles.append((self.task.database, ways, buff,
+                              (minx + i * width, miny + j * height,
+                               minx + (i + 1) * width,
+                               miny + (j + 1) * height),
+                              self.to_buffers_crs("{0}"),
+                              self.from_buffers_crs("{0}")))
+        # With --jobs the task is analysed in a daemonic process of a pool,
+        # which cannot start other processes
+        workers = min(self.task.workers, len(tiles))
+        if current_process().daemon:
+            workers = 1
+        print "- compare {0} tiles with {1} workers".format(
+            len(tiles), workers)
+
+        # The results are inserted when all the workers have finished,
+        # since the commit would wait for the locks held by their queries
+        results = []
+        if workers == 1:
+            for tile in tiles:
+                results.extend(compare_tile(tile))
+        else:
+            pool = Pool(workers)
+            try:
+                for rows in pool.imap_unordered(compare_tile, tiles):
+                    results.extend(rows)
+            finally:
+                pool.close()
+                pool.join()
+
+        sql = """
+            CREATE TABLE {0}_tiles (
+            way_id INTEGER NOT NULL,
+            Geometry BLOB NOT NULL);""".format(table)
         self.task.execute("spatialite", sql)
+        self.task.session.executemany(
+            ("INSERT INTO {0}_tiles (way_id, Geometry) "
+             "VALUES (?, GeomFromWKB(?, 4326));").format(table),
+            [(way_id, sqlite3.Binary(wkb)) for way_id, wkb in results])
+
+        # Stitch the pieces of each way
+        sql = """
+            CREATE TABLE {0}_MIXED AS
+            SELECT way_id, ST_LineMerge(ST_Union(Geometry)) AS Geometry
+            FROM {0}_tiles
+            GROUP BY way_id;""".format(table)
+        self.task.execute("spatialite", sql)
+
+    def store_osm_file_state(self):
+        sql = """
+            DROP TABLE IF EXISTS osm_file_state;
+            CREATE TABLE osm_file_state (size INTEGER, mtime REAL);
+            INSERT INTO osm_file_state VALUES ({0}, {1!r});""".format(
+            *self.osm_file_state())
+        self.task.execute("spatialite", sql)
+
+    def osm_file_analysed(self):
+        """Return True if the database has the OSM data of the OSM file.
+        """
+        sql = ("SELECT name FROM sqlite_master "
+               "WHERE name = 'osm_file_state';")
+        if not self.task.session.query(sql):
+            return False
+        sql = "SELECT size, mtime FROM osm_file_state;"
+        return (tuple(self.task.session.query(sql)[0]) ==
+                self.osm_file_state())
+
+    def can_update(self):
+        # Segments are not updated with --incremental
+        if self.task.comparison != "buffers":
+            return False
+        sql = "PRAGMA table_info(open_data_ways);"
+        return "hash" in [row[1] for row in self.task.session.query(sql)]
+
+    def drop_tables(self, tables):
+        """Drop tables, their spatial index and geometry column.
+        """
+        sql = ""
+        for table in tables:
+            sql += """
+                SELECT DisableSpatialIndex('{0}', 'Geometry');
+                DROP TABLE IF EXISTS idx_{0}_Geometry;
+                SELECT DiscardGeometryColumn('{0}', 'Geometry');
+                DROP TABLE IF EXISTS {0};""".format(table)
+        self.task.execute("spatialite", sql)
+
+    def temporary_tables(self):
+        """Tables created by update_db() and not needed by next executions.
+        """
+        tables = ["raw_osm_ways", "raw_osm_ways_inside", "changed"]
+        for ways in ("osm_ways", "open_data_ways"):
+            tables += ["{0}_{1}".format(ways, suffix) for suffix in
+                       ("new", "new_MIXED", "new_MULTILINESTRING",
+                        "new_SINGLELINESTRING", "removed", "added",
+                        "affected", "intersecting", "projected")]
+        for table in self.task.statuses:
+            tables += ["{0}_{1}".format(table, suffix) for suffix in
+                       ("update", "update_MIXED", "update_MULTILINESTRING",
+                        "update_SINGLELINESTRING")]
+        return tables
+
+    def update_db(self):
+        """Update the database of the previous analysis with new OSM and
+           open data. Ways are compared again only near the ways that were
+           added or removed since the previous analysis.
+        """
+        print "- Remove data produced by previous executions of the script"
+        self.drop_tables(self.temporary_tables())
+        self.set_metric_srid(self.read_boundaries_extent())
+
+        # The import is skipped when the OSM file is the one of the last
+        # successful analysis (e.g. --update_osm found no change files)
+        new_tables = {"osm_ways": "osm_ways_new",
+                      "open_data_ways": "open_data_ways_new"}
+        if self.osm_file_analysed():
+            print "\n- OSM data has not changed since the last analysis"
+            new_tables["osm_ways"] = "osm_ways"
+        else:
+            self.import_osm_data("osm_ways_new")
+        self.import_open_data("open_data_ways_new")
+
+        print "\n- find changed ways"
+        sql = ""
+        for ways in ("osm_ways", "open_data_ways"):
+            sql += """
+                CREATE TABLE {0}_removed AS
+                SELECT ROWID AS way_id, Geometry
+                FROM {0}
+                WHERE hash NOT IN (SELECT hash FROM {1});
+
+                CREATE TABLE {0}_added AS
+                SELECT Geometry, hash
+                FROM {1}
+                WHERE hash NOT IN (SELECT hash FROM {0});""".format(
+                ways, new_tables[ways])
+        self.task.execute("spatialite", sql)
+
+        # Area where the results may change: buffers of changed ways
+        sql = """
+            CREATE TABLE changed AS
+            SELECT {0} AS Geometry
+            FROM (SELECT Geometry FROM osm_ways_removed
+                  UNION ALL SELECT Geometry FROM osm_ways_added
+                  UNION ALL SELECT Geometry FROM open_data_ways_removed
+                  UNION ALL SELECT Geometry FROM open_data_ways_added)
+            WHERE {1} NOT NULL;""".format(
+            self.from_buffers_crs(self.buffer("Geometry")),
+            self.buffer("Geometry"))
+        self.task.execute("spatialite", sql)
+        changes = self.task.session.query("SELECT Count(*) FROM changed;")
+        print "changed ways:", changes[0][0]
+        if changes[0][0] == 0:
+            self.drop_tables(self.temporary_tables())
+            return
+        sql = """
+            SELECT RecoverGeometryColumn('changed', 'Geometry',
+            4326, 'POLYGON', 'XY');
+            SELECT CreateSpatialIndex('changed', 'Geometry');"""
+        self.task.execute("spatialite", sql)
+
+        print "\n- remove results of removed ways"
+        sql = """
+            DELETE FROM notinosm
+            WHERE way_id IN (SELECT way_id FROM open_data_ways_removed);
+            DELETE FROM onlyinosm
+            WHERE way_id IN (SELECT way_id FROM osm_ways_removed);"""
+        self.task.execute("spatialite", sql)
+
+        print "\n- update ways and buffers"
+        for ways in ("osm_ways", "open_data_ways"):
+            sql = """
+                DELETE FROM {0}_buffer
+                WHERE way_id IN (SELECT way_id FROM {0}_removed);
+                DELETE FROM {0}
+                WHERE ROWID IN (SELECT way_id FROM {0}_removed);
+                INSERT INTO {0} (Geometry, hash)
+                SELECT Geometry, hash FROM {0}_added;
+                INSERT INTO {0}_buffer (way_id, Geometry)
+                {1};""".format(ways, self.buffers_sql(
+                    ways, "hash IN (SELECT hash FROM {0}_added)".format(
+                        ways)))
+            self.task.execute("spatialite", sql)
+
+        for table in self.task.statuses:
+            (ways, buff) = self.compared_tables(table)
+            sql = """
+                CREATE TABLE {ways}_affected AS
+                SELECT DISTINCT way.ROWID AS way_id
+                FROM changed AS c, {ways} AS way
+                WHERE way.ROWID IN (
+                    SELECT ROWID
+                    FROM SpatialIndex
+                    WHERE f_table_name = '{ways}'
+                    AND search_frame = c.Geometry)
+                AND ST_Intersects(way.Geometry, c.Geometry);
+
+                DELETE FROM {table}
+                WHERE way_id IN (SELECT way_id FROM {ways}_affected);
+                """.format(table=table, ways=ways)
+            self.task.execute("spatialite", sql)
+
+            update = "{0}_update".format(table)
+            self.find_differences(update, ways, buff,
+                                  "{0}_affected".format(ways))
+            sql = """
+                INSERT INTO {0} (way_id, Geometry)
+                SELECT way_id, Geometry FROM {1};""".format(table, update)
+            self.task.execute("spatialite", sql)
+
+        self.drop_tables(self.temporary_tables())
@@ -58,11 +58,64 @@ class App():
                                 "properties from the project file",
                            action="store_true")
 
+        group.add_argument("--update_osm",
+                           help="update the OSM data of a task by applying "
+                                "the change files (.osc) in the directory "
+                                "written in \"changes_dir\" properties from "
+                                "the project file, instead of downloading "
+                                "it again",
+                           action="store_true")
+
+        parser.add_argument("--cache_dir",
+                            help="with --download_osm or --filter_osm, "
+                                 "keep the OSM extracts in this directory "
+                                 "and reuse them for the tasks with the "
+                                 "same Overpass query or osmfilter command "
+                                 "(and unchanged input files)",
+                            metavar=("DIR"))
+
+        parser.add_argument("--cache_ttl",
+                            help="hours after which a cached OSM extract "
+                                 "is downloaded again (default: 24)",
+                            type=float,
+                            default=24,
+                            metavar=("HOURS"))
+
+        parser.add_argument("--cache_size",
+                            help="maximum size of the OSM cache in MB; the "
+                                 "least recently used extracts are removed "
+                                 "(default: 2048)",
+                            type=float,
+                            default=2048,
+                            metavar=("MB"))
+
         parser.add_argument("-a", "--analyse",
                             help="compare the OSM data with open data"
                                  " and produce output files",
                             action="store_true")
 
+        parser.add_argument("--incremental",
+                            help="with -a, update the database of the "
+                                 "previous analysis of a task with the new "
+                                 "data and compare again only the ways near "
+                                 "the changed ones, instead of repeating the "
+                                 "whole analysis (highwaysgeometryspatialite)",
+                            action="store_true")
+
+        parser.add_argument("-j", "--jobs",
+                            help="number of tasks analysed in parallel with"
+                                 " -a (default: 1). The output of each task"
+                                 " is printed when its analysis ends",
+                            type=int,
+                            default=1,
+                            metavar=("N"))
+
+        parser.add_argument("--profile",
+                            help="with -a or -w, write a cProfile of each "
+                                 "stage and the query plans of its SQL "
+                                 "statements in data/profile/TASKNAME",
+                            action="store_true")
+
         parser.add_argument("-w", "--create_web_page",
                             help="read analysis' output files, create map data"
                                  " (GeoJSON or PNG tiles) and create the web"
@@ -77,6 +130,16 @@ class App():
                                  "to render the map tiles",
                             action="store_true")
 
+        parser.add_argument("--serve",
+                            help="serve the project's web page at "
+                                 "http://localhost:PORT/ (default: 8000), "
+                                 "with the tiles of the tasks whose "
+                                 "\"tiles_format\" is \"mbtiles\"",
+                            type=int,
+                            nargs="?",
+                            const=8000,
+                            metavar=("PORT"))
+
         parser.add_argument("-t", "--tasks",
                             help="execute -a, -w or --create_web_page_no_data "
                                  "only with the tasks whose name is in this "
@@ -111,11 +174,9 @@ class App():
 
         # Analyse
         if self.args.analyse:
-            for task in project.tasks:
-                print "\n= Task: {0} =".format(task.name)
-                # Download OSM data, compare with open data
-                # and produce output files
-                task.compare()
+            # Download OSM data, compare with open data
+            # and produce output files
+            project.analyse()
 
         # Create the web page
         if self.args.create_web_page or self.args.create_web_page_no_data:
@@ -129,5 +190,9 @@ class App():
         end = time.time()
         print "\nExecution time: ", end - start, "seconds."
 
+        # Serve the web page
+        if self.args.serve is not None:
+            project.serve(self.args.serve)
+
 if __name__ == "__main__":
     app = App()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import sys
+import time
+import struct
+import sqlite3
+
+# Statements whose query plan is written by --profile
+EXPLAINABLE = re.compile(r"(SELECT|INSERT|UPDATE|DELETE|WITH|"
+                         r"CREATE\s+TABLE\s+\S+\s+AS)\b", re.IGNORECASE)
+
+
+def split_statements(sql):
+    """Split a SQL script in single statements.
+       sqlite3.complete_statement() knows about quotes and comments, so
+       it works for both Spatialite and PostGIS scripts.
+    """
+    statements = []
+    statement = ""
+    for line in sql.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            if statement.strip().strip(";").strip() != "":
+                statements.append(statement.strip())
+            statement = ""
+    if statement.strip() != "":
+        statements.append(statement.strip())
+    return statements
+
+
+def connect_spatialite(database):
+    """Open a sqlite3 connection to a Spatialite database.
+    """
+    connection = sqlite3.connect(database)
+    # Transactions are handled by begin()/commit()
+    connection.isolation_level = None
+    try:
+        connection.enable_load_extension(True)
+        connection.load_extension("mod_spatialite")
+    except (AttributeError, sqlite3.OperationalError):
+        sys.exit("\n* Error: mod_spatialite cannot be loaded in Python"
+                 " sqlite3 module. Install libsqlite3-mod-spatialite.")
+    return connection
+
+
+class BinaryCopyReader(object):
+    """File-like object with the rows of a binary COPY, encoded while
+       they are read by psycopg2. Values may be int (bigint), unicode
+       (text), buffer (e.g. EWKB geometries) or None.
+    """
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.data = "PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+        self.done = False
+        self.count = 0
+
+    def encode(self, row):
+        fields = [struct.pack("!h", len(row))]
+        for value in row:
+            if value is None:
+                fields.append(struct.pack("!i", -1))
+                continue
+            if isinstance(value, (int, long)):
+                value = struct.pack("!q", value)
+            elif isinstance(value, unicode):
+                value = value.encode("utf-8")
+            else:
+                value = str(value)
+            fields.append(struct.pack("!i", len(value)))
+            fields.append(value)
+        return "".join(fields)
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.data) < size):
+            try:
+                self.data += self.encode(next(self.rows))
+                self.count += 1
+            except StopIteration:
+                self.data += struct.pack("!h", -1)
+                self.done = True
+        if size < 0:
+            size = len(self.data)
+        (data, self.data) = (self.data[:size], self.data[size:])
+        return data
+
+
+class Session(object):
+    """A connection to the database of a task, kept open for the whole
+       analysis. It is opened on first use, so that the database can be
+       created by external tools (e.g. spatialite_tool, createdb) before.
+       Subclasses open the connection with connect().
+    """
+    def __init__(self, task):
+        self.task = task
+        self.connection = None
+        # (seconds, statement) of every executed statement
+        self.timings = []
+        # With --profile, (statement, query plan) of the executed
+        # statements of the current stage
+        self.explain = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def cursor(self):
+        if self.connection is None:
+            self.connection = self.connect()
+        return self.connection.cursor()
+
+    def execute(self, sql):
+        """Execute the statements of a SQL script in a single transaction
+           and print the time taken by each of them.
+        """
+        cursor = self.cursor()
+        self.begin()
+        try:
+            for statement in split_statements(sql):
+                print statement
+                if self.explain is not None:
+                    self.explain_statement(cursor, statement)
+                start = time.time()
+                cursor.execute(statement)
+                elapsed = time.time() - start
+                self.timings.append((elapsed, statement))
+                print "-- {0:.3f} s".format(elapsed)
+        except:
+            self.rollback()
+            raise
+        self.commit()
+        cursor.close()
+
+    def explain_statement(self, cursor, statement):
+        """Store the query plan of statement, before executing it.
+        """
+        # Skip the comments before the statement
+        code = re.sub(r"^(\s*--[^\n]*\n)*\s*", "", statement)
+        if not EXPLAINABLE.match(code):
+            return
+        try:
+            cursor.execute("{0} {1}".format(self.explain_command, statement))
+            plan = "\n".join([" ".join([str(c) for c in row])
+                              for row in cursor.fetchall()])
+        except Exception as e:
+            plan = "{0}: {1}".format(e.__class__.__name__, e)
+        self.explain.append((statement, plan))
+
+    def executemany(self, statement, rows):
+        """Insert rows with a single statement, in a transaction.
+        """
+        cursor = self.cursor()
+        self.begin()
+        try:
+            start = time.time()
+            cursor.executemany(statement, rows)
+            elapsed = time.time() - start
+        except:
+            self.rollback()
+            raise
+        self.commit()
+        cursor.close()
+        self.timings.append((elapsed, statement))
+        print "{0}\n-- {1:.3f} s".format(statement, elapsed)
+
+    def query(self, sql):
+        """Return the rows of a SELECT statement.
+        """
+        cursor = self.cursor()
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+        cursor.close()
+        return rows
+
+    def stream(self, sql, size=1000):
+        """Yield the rows of a SELECT statement in lists of size rows.
+        """
+        cursor = self.cursor()
+        cursor.execute(sql)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def print_timings(self, limit=5):
+        """Print the slowest statements executed so far.
+        """
+        total = sum([t[0] for t in self.timings])
+        print "\nSQL time: {0:.3f} s in {1} statements".format(
+            total, len(self.timings))
+        for elapsed, statement in sorted(self.timings, reverse=True)[:limit]:
+            print "{0:>10.3f} s  {1}".format(
+                elapsed, " ".join(statement.split())[:70])
+
+
+class SpatialiteSession(Session):
+    geojson_function = "AsGeoJSON"
+    explain_command = "EXPLAIN QUERY PLAN"
+
+    def connect(self):
+        return connect_spatialite(self.task.database)
+
+    def begin(self):
+        self.connection.execute("BEGIN;")
+
+    def commit(self):
+        self.connection.execute("COMMIT;")
+
+    def rollback(self):
+        self.connection.execute("ROLLBACK;")
+
+
+class PostgisSession(Session):
+    geojson_function = "ST_AsGeoJSON"
+    explain_command = "EXPLAIN"
+
+    def connect(self):
+        try:
+            import psycopg2
+        except ImportError:
+            sys.exit("\n* Error: psycopg2 is needed to use a comparator"
+                     " based on PostGIS. Install python-psycopg2.")
+        # Tables are created in the schema of the task
+        return psycopg2.connect(host="localhost",
+                                user=self.task.postgis_user,
+                                password=self.task.postgis_password,
+                                dbname=self.task.database,
+                                options="-c search_path={0},public".format(
+                                    self.task.schema))
+
+    def autocommit_connection(self, dbname):
+        import psycopg2
+        connection = psycopg2.connect(host="localhost",
+                                      user=self.task.postgis_user,
+                                      password=self.task.postgis_password,
+                                      dbname=dbname)
+        connection.autocommit = True
+        return connection
+
+    def create_database(self):
+        """Create the database shared by the tasks and its PostGIS
+           extension, if they are missing.
+        """
+        connection = self.autocommit_connection("postgres")
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s;",
+                       (self.task.database, ))
+        if cursor.fetchone() is None:
+            print "CREATE DATABASE {0};".format(self.task.database)
+            cursor.execute("CREATE DATABASE {0};".format(self.task.database))
+        cursor.close()
+        connection.close()
+
+        connection = self.autocommit_connection(self.task.database)
+        cursor = connection.cursor()
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis SCHEMA public;")
+        cursor.close()
+        connection.close()
+
+    def copy(self, table, columns, rows):
+        """Load rows in table with a binary COPY, in a transaction.
+           rows are encoded while they are sent (see BinaryCopyReader).
+        """
+        statement = "COPY {0} ({1}) FROM STDIN WITH (FORMAT binary);".format(
+            table, ", ".join(columns))
+        reader = BinaryCopyReader(rows)
+        cursor = self.cursor()
+        try:
+            start = time.time()
+            cursor.copy_expert(statement, reader, size=65536)
+            elapsed = time.time() - start
+        except:
+            self.rollback()
+            raise
+        self.commit()
+        cursor.close()
+        self.timings.append((elapsed, statement))
+        print "{0}\n-- {1:.3f} s, {2} rows".format(statement, elapsed,
+                                                   reader.count)
+        return reader.count
+
+    def execute(self, sql):
+        # VACUUM cannot run inside a transaction block
+        statements = split_statements(sql)
+        batch = []
+        for statement in statements:
+            if statement.upper().startswith("VACUUM"):
+                if batch:
+                    Session.execute(self, "\n".join(batch))
+                    batch = []
+                self.vacuum(statement)
+            else:
+                batch.append(statement)
+        if batch:
+            Session.execute(self, "\n".join(batch))
+
+    def explain_statement(self, cursor, statement):
+        # A failed EXPLAIN would abort the transaction of the script.
+        # EXPLAIN has no effects, so it can always be rolled back
+        cursor.execute("SAVEPOINT explain;")
+        Session.explain_statement(self, cursor, statement)
+        cursor.execute("ROLLBACK TO SAVEPOINT explain;")
+        cursor.execute("RELEASE SAVEPOINT explain;")
+
+    def stream(self, sql, size=1000):
+        # A server side cursor avoids loading all the rows in memory
+        if self.connection is None:
+            self.connection = self.connect()
+        cursor = self.connection.cursor(name="stream")
+        cursor.itersize = size
+        cursor.execute(sql)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+        self.connection.commit()
+
+    def vacuum(self, statement):
+        cursor = self.cursor()
+        self.connection.autocommit = True
+        print statement
+        start = time.time()
+        cursor.execute(statement)
+        elapsed = time.time() - start
+        self.timings.append((elapsed, statement))
+        print "-- {0:.3f} s".format(elapsed)
+        self.connection.autocommit = False
+        cursor.close()
+
+
+SESSIONS = {"spatialite": SpatialiteSession,
+            "postgis": PostgisSession}
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import gzip
+import json
+
+WGS84_PRJ = ('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",'
+             'SPHEROID["WGS_1984",6378137,298.257223563]],'
+             'PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]')
+
+
+class GeoJSONWriter:
+    """Write features to a GeoJSON file while they are read from the
+       database. With sequence=True, a feature per line is written
+       (newline-delimited GeoJSON) instead of a FeatureCollection.
+    """
+    def __init__(self, path, sequence=False, compress=False):
+        self.sequence = sequence
+        if compress:
+            self.fp = gzip.open(path, "wb")
+        else:
+            self.fp = open(path, "w")
+        self.count = 0
+        if not self.sequence:
+            self.fp.write('{"type": "FeatureCollection", "features": [\n')
+
+    def write(self, geometry):
+        """geometry is a GeoJSON geometry, as text.
+        """
+        if self.count > 0 and not self.sequence:
+            self.fp.write(",\n")
+        self.fp.write('{{"type": "Feature", "properties": {{}}, '
+                      '"geometry": {0}}}'.format(geometry))
+        if self.sequence:
+            self.fp.write("\n")
+        self.count += 1
+
+    def close(self):
+        if not self.sequence:
+            self.fp.write("\n]}\n")
+        self.fp.close()
+
+
+class ShapefileWriter:
+    """Write features to a WGS84 Shapefile with pyshp.
+    """
+    def __init__(self, path, geometry_type):
+        try:
+            import shapefile
+        except ImportError:
+            sys.exit("\n* Error: pyshp is needed to export the results as "
+                     "Shapefile. Install it with: pip install pyshp")
+        self.path = path[:-4]
+        self.geometry_type = geometry_type
+        if geometry_type == "points":
+            shape_type = shapefile.POINT
+        else:
+            shape_type = shapefile.POLYLINE
+        self.writer = shapefile.Writer(self.path, shapeType=shape_type)
+        self.writer.field("id", "N", 10)
+        self.count = 0
+
+    def write(self, geometry):
+        """geometry is a GeoJSON geometry, as text.
+        """
+        geometry = json.loads(geometry)
+        coordinates = geometry["coordinates"]
+        if geometry["type"] == "Point":
+            self.writer.point(*coordinates)
+        elif geometry["type"] == "MultiPoint":
+            for point in coordinates:
+                self.writer.point(*point)
+                self.write_record()
+            return
+        elif geometry["type"] == "LineString":
+            self.writer.line([coordinates])
+        elif geometry["type"] == "MultiLineString":
+            self.writer.line(coordinates)
+        else:
+            return
+        self.write_record()
+
+    def write_record(self):
+        self.count += 1
+        self.writer.record(self.count)
+
+    def close(self):
+        self.writer.close()
+        with open(self.path + ".prj", "w") as fp:
+            fp.write(WGS84_PRJ)
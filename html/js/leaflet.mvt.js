@@ -0,0 +1,185 @@
+/*
+ * Leaflet tile layer drawing a layer of Mapbox Vector Tiles (.pbf)
+ * with LINESTRING features on canvas tiles.
+ *
+ * L.tileLayer.mvt("data/task/mvt/{z}/{x}/{y}.pbf",
+ *                 {layer: "notinosm", color: "red", maxDataZoom: 11})
+ *
+ * Above maxDataZoom, the tiles are drawn with the part of the tile of
+ * maxDataZoom that covers them.
+ */
+(function () {
+
+    function readVarint(buf, pos) {
+        var value = 0, shift = 0, b;
+        do {
+            b = buf[pos.i++];
+            value += (b & 0x7f) * Math.pow(2, shift);
+            shift += 7;
+        } while (b >= 0x80);
+        return value;
+    }
+
+    // Return [[fieldNumber, value], ...] of a message.
+    // value is a number (varint) or a subarray (length-delimited)
+    function readFields(buf) {
+        var fields = [], pos = {i: 0}, key, length;
+        while (pos.i < buf.length) {
+            key = readVarint(buf, pos);
+            if ((key & 7) === 0) {
+                fields.push([key >> 3, readVarint(buf, pos)]);
+            } else if ((key & 7) === 2) {
+                length = readVarint(buf, pos);
+                fields.push([key >> 3, buf.subarray(pos.i, pos.i + length)]);
+                pos.i += length;
+            } else if ((key & 7) === 5) {
+                pos.i += 4;
+            } else if ((key & 7) === 1) {
+                pos.i += 8;
+            }
+        }
+        return fields;
+    }
+
+    function readString(buf) {
+        var s = "";
+        for (var i = 0; i < buf.length; i++) {
+            s += String.fromCharCode(buf[i]);
+        }
+        return s;
+    }
+
+    // Return the lines of the features of a layer, in tile coordinates
+    function decodeLayer(buf, layerName) {
+        var tileFields = readFields(buf), lines = [];
+        for (var i = 0; i < tileFields.length; i++) {
+            if (tileFields[i][0] !== 3) {
+                continue;
+            }
+            var layerFields = readFields(tileFields[i][1]),
+                name = "", extent = 4096, features = [];
+            for (var j = 0; j < layerFields.length; j++) {
+                if (layerFields[j][0] === 1) {
+                    name = readString(layerFields[j][1]);
+                } else if (layerFields[j][0] === 2) {
+                    features.push(layerFields[j][1]);
+                } else if (layerFields[j][0] === 5) {
+                    extent = layerFields[j][1];
+                }
+            }
+            if (name !== layerName) {
+                continue;
+            }
+            for (var f = 0; f < features.length; f++) {
+                var featureFields = readFields(features[f]);
+                for (var k = 0; k < featureFields.length; k++) {
+                    if (featureFields[k][0] === 4) {
+                        decodeGeometry(featureFields[k][1], extent, lines);
+                    }
+                }
+            }
+        }
+        return lines;
+    }
+
+    function decodeGeometry(buf, extent, lines) {
+        var pos = {i: 0}, x = 0, y = 0, cmd, count, line, n, dx, dy;
+        while (pos.i < buf.length) {
+            n = readVarint(buf, pos);
+            cmd = n & 7;
+            count = Math.floor(n / 8);
+            if (cmd === 7) {
+                continue;
+            }
+            for (var c = 0; c < count; c++) {
+                dx = readVarint(buf, pos);
+                dy = readVarint(buf, pos);
+                x += (dx % 2) ? -(dx + 1) / 2 : dx / 2;
+                y += (dy % 2) ? -(dy + 1) / 2 : dy / 2;
+                if (cmd === 1) {
+                    line = [];
+                    lines.push(line);
+                }
+                line.push([x / extent, y / extent]);
+            }
+        }
+    }
+
+    var MVT = {
+        decodeLayer: decodeLayer
+    };
+
+    if (typeof L !== "undefined") {
+        L.TileLayer.MVT = L.TileLayer.Canvas.extend({
+            options: {
+                async: true,
+                layer: "",
+                color: "red",
+                maxDataZoom: 18,
+                weight: 3,
+                opacity: 1
+            },
+
+            initialize: function (url, options) {
+                this._mvtUrl = url;
+                L.TileLayer.Canvas.prototype.initialize.call(this, options);
+            },
+
+            drawTile: function (canvas, tilePoint, zoom) {
+                var layer = this,
+                    xhr = new XMLHttpRequest(),
+                    z = Math.min(zoom, this.options.maxDataZoom),
+                    scale = Math.pow(2, zoom - z),
+                    x = Math.floor(tilePoint.x / scale),
+                    y = Math.floor(tilePoint.y / scale),
+                    // Position of the tile in the tile of zoom z
+                    offset = [tilePoint.x - x * scale, tilePoint.y - y * scale];
+                xhr.open("GET", L.Util.template(this._mvtUrl, {
+                    x: x, y: y, z: z}));
+                xhr.responseType = "arraybuffer";
+                xhr.onload = function () {
+                    if (xhr.status === 200) {
+                        layer._drawLines(canvas, decodeLayer(
+                            new Uint8Array(xhr.response), layer.options.layer),
+                            scale, offset);
+                    }
+                    layer.tileDrawn(canvas);
+                };
+                xhr.onerror = function () {
+                    layer.tileDrawn(canvas);
+                };
+                xhr.send();
+            },
+
+            _drawLines: function (canvas, lines, scale, offset) {
+                var ctx = canvas.getContext("2d"),
+                    size = canvas.width * scale,
+                    dx = offset[0] * canvas.width,
+                    dy = offset[1] * canvas.width;
+                ctx.strokeStyle = this.options.color;
+                ctx.lineWidth = this.options.weight;
+                ctx.globalAlpha = this.options.opacity;
+                ctx.beginPath();
+                for (var i = 0; i < lines.length; i++) {
+                    for (var j = 0; j < lines[i].length; j++) {
+                        var p = lines[i][j];
+                        if (j === 0) {
+                            ctx.moveTo(p[0] * size - dx, p[1] * size - dy);
+                        } else {
+                            ctx.lineTo(p[0] * size - dx, p[1] * size - dy);
+                        }
+                    }
+                }
+                ctx.stroke();
+            }
+        });
+
+        L.tileLayer.mvt = function (url, options) {
+            return new L.TileLayer.MVT(url, options);
+        };
+    }
+
+    if (typeof module === "object" && module.exports) {
+        module.exports = MVT;
+    }
+}());
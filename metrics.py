@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import pstats
+import cProfile
+import resource
+from contextlib import contextmanager
+
+# Number of executions whose metrics are kept in project_output.json
+HISTORY_SIZE = 100
+
+
+def reset_peak_memory():
+    """Reset the peak RSS of the process, so that ru_maxrss is the peak
+       of the next stage. Possible only on Linux.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except (IOError, OSError):
+        pass
+
+
+def files_size(paths):
+    """Return the bytes of the files in paths (files or directories).
+    """
+    size = 0
+    for path in paths:
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for f in files:
+                    size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+class Metrics:
+    """Metrics of the stages of a task: wall and CPU time, peak memory,
+       rows and features read (rows_in, features_in) and written
+       (rows_out, features_out, tiles_out), bytes written. The metrics of
+       previous executions are kept as history in project_output.json.
+       With profile_dir, a cProfile of each stage and the query plans of
+       its SQL statements are written there.
+    """
+    def __init__(self, task, history, profile_dir=None):
+        self.task = task
+        self.history = history
+        self.profile_dir = profile_dir
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, paths=()):
+        """Measure the code executed in the with block. The yielded dict
+           can be filled with counts, e.g. record["features_out"].
+           paths are the files written by the stage.
+        """
+        record = {"stage": name}
+        if self.profile_dir is not None:
+            profiler = cProfile.Profile()
+            self.task.session.explain = []
+        reset_peak_memory()
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.time()
+        if self.profile_dir is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if self.profile_dir is not None:
+                profiler.disable()
+            record["wall_s"] = round(time.time() - start, 3)
+            self_end = resource.getrusage(resource.RUSAGE_SELF)
+            children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record["cpu_s"] = round(
+                self_end.ru_utime - self_usage.ru_utime +
+                self_end.ru_stime - self_usage.ru_stime, 3)
+            record["children_cpu_s"] = round(
+                children_end.ru_utime - children_usage.ru_utime +
+                children_end.ru_stime - children_usage.ru_stime, 3)
+            # KB on Linux. The peak of children is the highest of all the
+            # children waited so far
+            record["max_rss_kb"] = self_end.ru_maxrss
+            record["children_max_rss_kb"] = children_end.ru_maxrss
+            if paths:
+                record["bytes_written"] = files_size(paths)
+            self.stages.append(record)
+            if self.profile_dir is not None:
+                self.write_profile(name, profiler)
+
+    def write_profile(self, name, profiler):
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        path = os.path.join(self.profile_dir, name.replace(":", "_"))
+        profiler.dump_stats(path + ".prof")
+        with open(path + ".txt", "w") as fp:
+            stats = pstats.Stats(profiler, stream=fp)
+            stats.sort_stats("cumulative").print_stats(40)
+        with open(path + ".sql.txt", "w") as fp:
+            for (statement, plan) in self.task.session.explain:
+                fp.write("{0}\n\n{1}\n\n{2}\n\n".format(statement, plan,
+                                                        "-" * 79))
+        self.task.session.explain = None
+        print "profile of {0} written to {1}.*".format(name, path)
+
+    def print_stages(self):
+        if not self.stages:
+            return
+        print "\nStages:"
+        for record in self.stages:
+            print "{0:>10.3f} s {1:>10.3f} s CPU {2:>9} KB  {3}".format(
+                record["wall_s"], record["cpu_s"], record["max_rss_kb"],
+                record["stage"])
+
+    def updated_history(self):
+        """Return the history of the metrics, with the ones of this
+           execution.
+        """
+        if not self.stages:
+            return self.history
+        execution = {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                     "stages": self.stages}
+        return (self.history + [execution])[-HISTORY_SIZE:]
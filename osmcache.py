@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import shutil
+import hashlib
+
+
+class OSMCache:
+    """Cache of OSM extracts (PBF files), shared by tasks and projects.
+       Files are named by the hash of what produced them (e.g. an Overpass
+       query), expire after ttl seconds and the least recently used ones
+       are removed when the cache is bigger than max_size bytes.
+       The modification time of a file is the time it was cached, its
+       access time the time it was last used.
+    """
+    def __init__(self, directory, ttl, max_size):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, *parts):
+        return hashlib.sha1("\n".join([unicode(p).encode("utf-8")
+                                       for p in parts])).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, "{0}.pbf".format(key))
+
+    def get(self, key, path):
+        """Copy the cached file of key to path. Return False if it is
+           missing or expired.
+        """
+        cached = self.path(key)
+        try:
+            mtime = os.path.getmtime(cached)
+            if time.time() - mtime > self.ttl:
+                os.remove(cached)
+                return False
+            shutil.copyfile(cached, path)
+            os.utime(cached, (time.time(), mtime))
+        except (IOError, OSError):
+            # Missing, or removed by another process
+            return False
+        return True
+
+    def put(self, key, path):
+        """Store a copy of path as the file of key and remove the least
+           recently used files, if the cache is too big.
+        """
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            return
+        cached = self.path(key)
+        tmp = "{0}.{1}.tmp".format(cached, os.getpid())
+        shutil.copyfile(path, tmp)
+        os.rename(tmp, cached)
+        self.evict()
+
+    def evict(self):
+        files = []
+        for f in os.listdir(self.directory):
+            if not f.endswith(".pbf"):
+                continue
+            path = os.path.join(self.directory, f)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_atime, stat.st_size, path))
+        size = sum([f[1] for f in files])
+        for (atime, file_size, path) in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= file_size
+            print "removed from the OSM cache: {0}".format(path)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+
+
+def read_highways(pbf_file, callback, batch_size=10000,
+                  index="sparse_mem_array"):
+    """Read the highways of an OSM PBF file in a single pass and call
+       callback with lists of (osm_id, highway, WKB linestring).
+       Blocks are decoded by libosmium (pyosmium). Node coordinates are
+       kept in a compact location index ("sparse_mem_array", or
+       "dense_mmap_array" for very big files), so memory does not depend
+       on the number of highways read.
+    """
+    try:
+        import osmium
+    except ImportError:
+        sys.exit("\n* Error: pyosmium is needed to read OSM data."
+                 " Install it with: pip install osmium")
+
+    class HighwaysHandler(osmium.SimpleHandler):
+        def __init__(self):
+            osmium.SimpleHandler.__init__(self)
+            self.factory = osmium.geom.WKBFactory()
+            self.rows = []
+            self.count = 0
+
+        def way(self, w):
+            highway = w.tags.get("highway")
+            if highway is None or w.tags.get("area") == "yes":
+                return
+            try:
+                wkb = self.factory.create_linestring(w)
+            except (osmium.InvalidLocationError, RuntimeError):
+                # Missing nodes or less than two different locations
+                return
+            self.rows.append((w.id, highway.decode("utf-8"),
+                              wkb.decode("hex")))
+            if len(self.rows) == batch_size:
+                self.flush()
+
+        def flush(self):
+            if self.rows:
+                callback(self.rows)
+                self.count += len(self.rows)
+                self.rows = []
+
+    handler = HighwaysHandler()
+    handler.apply_file(pbf_file, locations=True, idx=index)
+    handler.flush()
+    return handler.count
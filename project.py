@@ -19,9 +19,61 @@
 import os
 import sys
 import json
+import tempfile
+import traceback
+from multiprocessing import Pool, cpu_count
 from task import Task
+from osmcache import OSMCache
+from rendering.mbtiles import serve
 import jinja2
-from shutil import copytree
+from shutil import copytree, copyfile
+
+
+# Project whose tasks are analysed by the worker processes of
+# Project.analyse(). Workers are forked, so they inherit it
+_project = None
+
+
+def analyse_task(index):
+    """Analyse a task in a worker process.
+       Everything the task writes on stdout and stderr (including the
+       output of the executed commands) is buffered and returned, together
+       with the results that must be written in project_output.json and
+       the traceback of an unexpected exception.
+    """
+    task = _project.tasks[index]
+    log = tempfile.TemporaryFile()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    stdout = os.dup(1)
+    stderr = os.dup(2)
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    error = ""
+    error_traceback = ""
+    try:
+        task.compare()
+    except SystemExit as e:
+        error = str(e.code)
+    except Exception as e:
+        error = "{0}: {1}".format(e.__class__.__name__, e)
+        error_traceback = traceback.format_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        os.close(stdout)
+        os.close(stderr)
+    log.seek(0)
+    return {"index": index,
+            "log": log.read(),
+            "error": error,
+            "traceback": error_traceback,
+            "analysis_time": task.analysis_time,
+            "bbox": task.bbox,
+            "center": task.center,
+            "metrics": task.metrics.stages}
 
 
 class Project(object):
@@ -51,6 +103,12 @@ class Project(object):
                              os.path.join(self.html_dir, "css"))
                 else:
                     os.makedirs(d)
+        # Add the scripts of new versions of the program to old projects
+        app_js_dir = os.path.join(self.app.directory, "html", "js")
+        for file_name in os.listdir(app_js_dir):
+            js_file = os.path.join(self.html_dir, "js", file_name)
+            if not os.path.exists(js_file):
+                copyfile(os.path.join(app_js_dir, file_name), js_file)
 
         if "title" not in config:
             self.title = "Compare to OSM"
@@ -67,6 +125,27 @@ class Project(object):
         else:
             self.map_zoom = config["map_zoom"]
 
+        # Number of processes that render the tiles (default: number of CPUs)
+        if "render_workers" not in config:
+            self.render_workers = cpu_count()
+        else:
+            self.render_workers = int(config["render_workers"])
+
+        # Overpass API used by --download_osm (e.g. a local server for
+        # tests)
+        if "overpass_url" not in config:
+            self.overpass_url = "http://overpass-api.de/api/interpreter"
+        else:
+            self.overpass_url = config["overpass_url"]
+
+        # Cache of downloaded and filtered OSM extracts
+        if self.app.args.cache_dir is None:
+            self.osm_cache = None
+        else:
+            self.osm_cache = OSMCache(self.app.args.cache_dir,
+                                      self.app.args.cache_ttl * 3600,
+                                      self.app.args.cache_size * 1024 * 1024)
+
         # Tasks config
 
         # Analyse only the specified tasks (--tasks option)
@@ -94,6 +173,21 @@ class Project(object):
                                            in self.app.args.tasks):
                 self.tasks.append(task)
 
+        # Tasks of PostGIS comparators sharing a database must have
+        # different schemas, since a task drops its schema
+        schemas = {}
+        for task in self.allTasks:
+            if task.comparator.database_type != "postgis":
+                continue
+            key = (task.database, task.schema)
+            if key in schemas:
+                sys.exit("\n* Error: tasks \"{0}\" and \"{1}\" would use "
+                         "the same schema ({2}) of the PostGIS database. "
+                         "Rename one of them.".format(schemas[key],
+                                                      task.name,
+                                                      task.schema))
+            schemas[key] = task.name
+
     def read_file(self, filename):
         try:
             with open(filename) as fp:
@@ -108,6 +202,10 @@ class Project(object):
         print "map lat:", self.map_lat
         print "map lon:", self.map_lon
         print "map zoom:", self.map_zoom
+        print "render workers:", self.render_workers
+        print "overpass url:", self.overpass_url
+        if self.osm_cache is not None:
+            print "OSM cache:", self.osm_cache.directory
         print "\n== Tasks"
         for task in self.allTasks:
             print "\nname:", task.name
@@ -118,6 +216,56 @@ class Project(object):
             print "output:", task.output
             print "min zoom:", task.min_zoom
             print "max zoom:", task.max_zoom
+            print "analysis grid: {0}x{0}".format(task.grid)
+            print "export formats:", ", ".join(task.export_formats)
+
+    def analyse(self):
+        """Compare OSM data with open data for each task.
+           With --jobs N, N tasks are analysed at the same time in
+           different processes, since they use different databases.
+        """
+        jobs = self.app.args.jobs
+        if jobs <= 1 or len(self.tasks) == 1:
+            for task in self.tasks:
+                print "\n= Task: {0} =".format(task.name)
+                task.compare()
+            return
+
+        # The databases of PostGIS comparators are created before starting
+        # the processes, which would race to create them
+        for task in self.tasks:
+            if task.comparator.database_type == "postgis":
+                task.session.create_database()
+
+        global _project
+        _project = self
+        errors = []
+        pool = Pool(min(jobs, len(self.tasks)))
+        try:
+            for result in pool.imap_unordered(analyse_task,
+                                              range(len(self.tasks))):
+                task = self.tasks[result["index"]]
+                print "\n= Task: {0} =".format(task.name)
+                print result["log"].rstrip("\n")
+                if result["traceback"] != "":
+                    print result["traceback"].rstrip("\n")
+                if result["error"] != "":
+                    errors.append("{0}: {1}".format(task.name,
+                                                    result["error"]))
+                    continue
+                task.analysis_time = result["analysis_time"]
+                task.bbox = result["bbox"]
+                task.center = result["center"]
+                task.metrics.stages = result["metrics"]
+        finally:
+            pool.close()
+            pool.join()
+            _project = None
+
+        if errors:
+            self.update_output_file()
+            sys.exit("\n* Error: the analysis of these tasks failed:\n"
+                     "{0}".format("\n".join(errors)))
 
     def update_map_data(self):
         for task in self.tasks:
@@ -143,14 +291,21 @@ class Project(object):
         with open(os.path.join(self.html_dir, "index.html"), "w") as f:
             f.write(output_text)
 
+    def serve(self, port):
+        """Serve html/index.html and the tiles of MBTiles files.
+        """
+        serve(self.html_dir, port)
+
     def update_output_file(self):
         """Update the file that contains statistics of the analysis.
         """
         config = {"tasks": {}}
         for task in self.allTasks:
-            config["tasks"][task.name] = {"analysis_time": task.analysis_time,
-                                          "bbox": task.bbox,
-                                          "center": task.center}
+            config["tasks"][task.name] = {
+                "analysis_time": task.analysis_time,
+                "bbox": task.bbox,
+                "center": task.center,
+                "metrics": task.metrics.updated_history()}
 
         with open(self.project_output_file, "w") as fp:
             fp.write(json.dumps(config,
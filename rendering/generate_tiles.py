@@ -2,9 +2,14 @@
 from math import pi,cos,sin,log,exp,atan
 from subprocess import call
 import sys, os
-from Queue import Queue
+import time
+from collections import deque
+from multiprocessing import Pool, cpu_count
 
-import threading
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # try:
 #     import mapnik2 as mapnik
@@ -14,8 +19,9 @@ import mapnik
 DEG_TO_RAD = pi/180
 RAD_TO_DEG = 180/pi
 
-# Default number of rendering threads to spawn, should be roughly equal to number of CPU cores available
-NUM_THREADS = 4
+# Tiles are rendered in metatiles of METATILE x METATILE tiles: a single
+# image is rendered and then sliced in tiles
+METATILE = 8
 
 
 def minmax (a,b,c):
@@ -52,14 +58,175 @@ class GoogleProjection:
          h = RAD_TO_DEG * ( 2 * atan(exp(g)) - 0.5 * pi)
          return (f,h)
 
+    def fromLLtoPixelArray(self, lons, lats, zoom):
+        """Vectorized fromLLtoPixel (NumPy): convert arrays of longitudes
+           and latitudes to arrays of pixel coordinates.
+        """
+        d = self.zc[zoom]
+        e = numpy.round(d[0] + numpy.asarray(lons, float) * self.Bc[zoom])
+        f = numpy.clip(numpy.sin(DEG_TO_RAD * numpy.asarray(lats, float)),
+                       -0.9999, 0.9999)
+        g = numpy.round(d[1] + 0.5 * numpy.log((1 + f) / (1 - f)) *
+                        -self.Cc[zoom])
+        return (e, g)
+
+    def fromLLtoTileArray(self, lons, lats, zoom):
+        """Convert arrays of longitudes and latitudes to arrays of the x
+           and y of their tiles.
+        """
+        (px, py) = self.fromLLtoPixelArray(lons, lats, zoom)
+        last = 2 ** zoom - 1
+        return (numpy.clip(numpy.floor(px / 256), 0, last).astype(int),
+                numpy.clip(numpy.floor(py / 256), 0, last).astype(int))
+
+
+def occupied_tiles(lines, minZoom, maxZoom, buffer=4):
+    """Return {zoom: set of (x, y) tiles} touched by lines (lists of
+       (lon, lat)) buffered by buffer pixels, computed with NumPy.
+       Segments are split in pieces of half a tile at most, so each
+       piece touches 2x2 tiles at most (with buffer < 64).
+    """
+    tiles = dict((z, set()) for z in range(minZoom, maxZoom + 1))
+    lons = []
+    lats = []
+    first = []
+    for line in lines:
+        if len(line) == 1:
+            line = line * 2
+        for i, (lon, lat) in enumerate(line):
+            lons.append(lon)
+            lats.append(lat)
+            first.append(i == 0)
+    if len(lons) < 2:
+        return tiles
+
+    # Segments in pixels at maxZoom
+    (px, py) = GoogleProjection(maxZoom + 1).fromLLtoPixelArray(
+        lons, lats, maxZoom)
+    segments = ~numpy.array(first[1:])
+    x0 = px[:-1][segments]
+    y0 = py[:-1][segments]
+    dx = px[1:][segments] - x0
+    dy = py[1:][segments] - y0
+
+    for z in range(minZoom, maxZoom + 1):
+        scale = 2 ** (maxZoom - z)
+        size = 256.0 * scale
+        b = buffer * scale
+        last = 2 ** z - 1
+        steps = (numpy.maximum(numpy.abs(dx), numpy.abs(dy)) //
+                 (size / 2)).astype(int) + 1
+        # Pieces of segments
+        index = numpy.repeat(numpy.arange(len(steps)), steps)
+        k = numpy.arange(len(index)) - numpy.repeat(
+            numpy.cumsum(steps) - steps, steps)
+        t0 = k / steps[index].astype(float)
+        t1 = (k + 1) / steps[index].astype(float)
+        xa = x0[index] + dx[index] * t0
+        xb = x0[index] + dx[index] * t1
+        ya = y0[index] + dy[index] * t0
+        yb = y0[index] + dy[index] * t1
+        xs = [numpy.floor((numpy.minimum(xa, xb) - b) / size),
+              numpy.floor((numpy.maximum(xa, xb) + b) / size)]
+        ys = [numpy.floor((numpy.minimum(ya, yb) - b) / size),
+              numpy.floor((numpy.maximum(ya, yb) + b) / size)]
+        keys = []
+        for x in xs:
+            for y in ys:
+                x = numpy.clip(x, 0, last).astype(numpy.int64)
+                y = numpy.clip(y, 0, last).astype(numpy.int64)
+                keys.append(x * (last + 1) + y)
+        for key in numpy.unique(numpy.concatenate(keys)):
+            tiles[z].add((int(key // (last + 1)), int(key % (last + 1))))
+    return tiles
+
+
+class TileIndex:
+    """Quadtree of the tiles touched by some geometries, from minZoom to
+       maxZoom: a set of (x, y) tiles for each zoom.
+       Lines are walked in pixels and buffered by buffer pixels, so that
+       the tiles touched only by the width of a symbol are not missed.
+       A tile at zoom z+1 is non-empty only if its parent is non-empty.
+       The tiles are computed with NumPy, if it is installed.
+    """
+    def __init__(self, geometries, minZoom, maxZoom, buffer=4):
+        self.minZoom = minZoom
+        self.maxZoom = maxZoom
+        if numpy is not None:
+            self.tiles = occupied_tiles(
+                [line for lines in geometries for line in lines],
+                minZoom, maxZoom, buffer)
+            return
+        self.tiles = dict((z, set()) for z in range(minZoom, maxZoom + 1))
+        gprj = GoogleProjection(maxZoom + 1)
+        for lines in geometries:
+            for line in lines:
+                # Pixels at maxZoom
+                points = [gprj.fromLLtoPixel(ll, maxZoom) for ll in line]
+                for z in range(minZoom, maxZoom + 1):
+                    self.add_line(points, z, 2 ** (maxZoom - z), buffer)
+
+    def add_line(self, points, z, scale, buffer):
+        """points are in pixels at maxZoom, scale is the size of a pixel of
+           zoom z in pixels at maxZoom.
+        """
+        tiles = self.tiles[z]
+        size = 256.0 * scale
+        b = buffer * scale
+        last = 2 ** z - 1
+        for i in range(len(points)):
+            (x0, y0) = points[max(i - 1, 0)]
+            (x1, y1) = points[i]
+            # Split long segments in pieces of half a tile at most, so that
+            # the tiles crossed by their bbox are not too many
+            steps = int(max(abs(x1 - x0), abs(y1 - y0)) / (size / 2)) + 1
+            for s in range(steps):
+                xa = x0 + (x1 - x0) * s / steps
+                xb = x0 + (x1 - x0) * (s + 1) / steps
+                ya = y0 + (y1 - y0) * s / steps
+                yb = y0 + (y1 - y0) * (s + 1) / steps
+                for x in range(max(int((min(xa, xb) - b) // size), 0),
+                               min(int((max(xa, xb) + b) // size), last) + 1):
+                    for y in range(max(int((min(ya, yb) - b) // size), 0),
+                                   min(int((max(ya, yb) + b) // size),
+                                       last) + 1):
+                        tiles.add((x, y))
+
+    def walk(self):
+        """Yield the non-empty tiles as (x, y, z), zoom by zoom, descending
+           into the children of a tile only when it is non-empty.
+        """
+        queue = deque((x, y, self.minZoom)
+                      for (x, y) in sorted(self.tiles[self.minZoom]))
+        while queue:
+            (x, y, z) = queue.popleft()
+            yield (x, y, z)
+            if z == self.maxZoom:
+                continue
+            children = self.tiles[z + 1]
+            for child in ((2 * x, 2 * y), (2 * x, 2 * y + 1),
+                          (2 * x + 1, 2 * y), (2 * x + 1, 2 * y + 1)):
+                if child in children:
+                    queue.append((child[0], child[1], z + 1))
+
+    def intersection(self, other):
+        """Return a TileIndex of the tiles of both indexes.
+        """
+        index = TileIndex([], self.minZoom, self.maxZoom)
+        for z in index.tiles:
+            index.tiles[z] = self.tiles[z] & other.tiles[z]
+        return index
+
+    def __len__(self):
+        return sum(len(tiles) for tiles in self.tiles.values())
 
 
 class RenderThread:
-    def __init__(self, tile_dir, mapfile, q, printLock, maxZoom):
+    """Renderer of a rendering process, with its own mapnik.Map.
+    """
+    def __init__(self, tile_dir, mapfile, maxZoom):
         self.tile_dir = tile_dir
-        self.q = q
         self.m = mapnik.Map(256, 256)
-        self.printLock = printLock
         # Load style XML
         mapnik.load_map(self.m, mapfile, True)
         # Obtain <Map> projection
@@ -69,10 +236,21 @@ class RenderThread:
 
 
     def render_tile(self, tile_uri, x, y, z):
+        self.render_metatile([(tile_uri, x, y, z)])
+
+    def render_metatile(self, tiles):
+        """Render tiles (tile_uri, x, y, z) of the same zoom in a single
+           image, then slice it and save the non-empty tiles.
+        """
+        z = tiles[0][3]
+        x0 = min(t[1] for t in tiles)
+        x1 = max(t[1] for t in tiles) + 1
+        y0 = min(t[2] for t in tiles)
+        y1 = max(t[2] for t in tiles) + 1
 
         # Calculate pixel positions of bottom-left & top-right
-        p0 = (x * 256, (y + 1) * 256)
-        p1 = ((x + 1) * 256, y * 256)
+        p0 = (x0 * 256, y1 * 256)
+        p1 = (x1 * 256, y0 * 256)
 
         # Convert to LatLong (EPSG:4326)
         l0 = self.tileproj.fromPixelToLL(p0, z);
@@ -82,67 +260,63 @@ class RenderThread:
         c0 = self.prj.forward(mapnik.Coord(l0[0],l0[1]))
         c1 = self.prj.forward(mapnik.Coord(l1[0],l1[1]))
 
-        # Bounding box for the tile
+        # Bounding box for the metatile
         if hasattr(mapnik,'mapnik_version') and mapnik.mapnik_version() >= 800:
             bbox = mapnik.Box2d(c0.x,c0.y, c1.x,c1.y)
         else:
             bbox = mapnik.Envelope(c0.x,c0.y, c1.x,c1.y)
-        render_size = 256
-        self.m.resize(render_size, render_size)
+        width = (x1 - x0) * 256
+        height = (y1 - y0) * 256
+        self.m.resize(width, height)
         self.m.zoom_to_box(bbox)
         if(self.m.buffer_size < 128):
             self.m.buffer_size = 128
 
         # Render image with default Agg renderer
-        im = mapnik.Image(render_size, render_size)
+        im = mapnik.Image(width, height)
         mapnik.render(self.m, im)
-        if len(im.tostring('png256')) != 116:
-            im.save(tile_uri, 'png256:z=1')
-
-
-    def loop(self):
-        while True:
-            #Fetch a tile from the queue and render it
-            r = self.q.get()
-            if (r == None):
-                self.q.task_done()
-                break
-            else:
-                (name, tile_uri, x, y, z) = r
-
-            exists= ""
-            if os.path.isfile(tile_uri):
-                exists= "exists"
-            else:
-                self.render_tile(tile_uri, x, y, z)
-            """bytes=os.stat(tile_uri)[6]
-            empty= ''
-            if bytes == 103:
-                empty = " Empty Tile """
-            self.printLock.acquire()
-            #print name, ":", z, x, y, exists#, empty
-            self.printLock.release()
-            self.q.task_done()
-
-
-
-def render_tiles(bbox, mapfile, tile_dir, minZoom=1,maxZoom=18, name="unknown", num_threads=NUM_THREADS, tms_scheme=False):
-    print "render_tiles(",bbox, mapfile, tile_dir, minZoom,maxZoom, name,")\n..."
 
-    # Launch rendering threads
-    queue = Queue(32)
-    printLock = threading.Lock()
-    renderers = {}
-    for i in range(num_threads):
-        renderer = RenderThread(tile_dir, mapfile, queue, printLock, maxZoom)
-        render_thread = threading.Thread(target=renderer.loop)
-        render_thread.start()
-        #print "Started render thread %s" % render_thread.getName()
-        renderers[i] = render_thread
+        # Slice the tiles and save the non-empty ones.
+        # Tiles without tile_uri are returned as (x, y, z, data)
+        data = []
+        for (tile_uri, x, y, z) in tiles:
+            view = im.view((x - x0) * 256, (y - y0) * 256, 256, 256)
+            if len(view.tostring('png256')) != 116:
+                if tile_uri is None:
+                    data.append((x, y, z, view.tostring('png256:z=1')))
+                else:
+                    view.save(tile_uri, 'png256:z=1')
+        return data
 
-    if not os.path.isdir(tile_dir):
-         os.mkdir(tile_dir)
+    def render_chunk(self, chunk):
+        """Render the tiles of a chunk, (tile_uri, x, y, z) tuples in the
+           same metatile, with a single mapnik.render call.
+           Return the number of tiles and the data of the tiles without
+           tile_uri.
+        """
+        tiles = [t for t in chunk if t[0] is None
+                 or not os.path.isfile(t[0])]
+        if not tiles:
+            return (len(chunk), [])
+        return (len(chunk), self.render_metatile(tiles))
+
+
+# Renderer of each rendering process
+_renderer = None
+
+
+def init_renderer(tile_dir, mapfile, maxZoom):
+    global _renderer
+    _renderer = RenderThread(tile_dir, mapfile, maxZoom)
+
+
+def render_chunk(chunk):
+    return _renderer.render_chunk(chunk)
 
+
+def bbox_tiles(bbox, minZoom, maxZoom):
+    """Yield all the tiles of bbox as (x, y, z).
+    """
     gprj = GoogleProjection(maxZoom+1)
 
     ll0 = (bbox[0],bbox[3])
@@ -152,42 +326,93 @@ def render_tiles(bbox, mapfile, tile_dir, minZoom=1,maxZoom=18, name="unknown",
         px0 = gprj.fromLLtoPixel(ll0,z)
         px1 = gprj.fromLLtoPixel(ll1,z)
 
-        # check if we have directories in place
-        zoom = "%s" % z
-        if not os.path.isdir(tile_dir + zoom):
-            os.mkdir(tile_dir + zoom)
         for x in range(int(px0[0]/256.0),int(px1[0]/256.0)+1):
             # Validate x co-ordinate
             if (x < 0) or (x >= 2**z):
                 continue
-            # check if we have directories in place
-            str_x = "%s" % x
-            if not os.path.isdir(tile_dir + zoom + '/' + str_x):
-                os.mkdir(tile_dir + zoom + '/' + str_x)
             for y in range(int(px0[1]/256.0),int(px1[1]/256.0)+1):
                 # Validate x co-ordinate
                 if (y < 0) or (y >= 2**z):
                     continue
-                # flip y to match OSGEO TMS spec
-                if tms_scheme:
-                    str_y = "%s" % ((2**z-1) - y)
-                else:
-                    str_y = "%s" % y
-                tile_uri = tile_dir + zoom + '/' + str_x + '/' + str_y + '.png'
-                # Submit tile to be rendered into the queue
-                t = (name, tile_uri, x, y, z)
-                try:
-                    queue.put(t)
-                except KeyboardInterrupt:
-                    raise SystemExit("Ctrl-c detected, exiting...")
-
-    # Signal render threads to exit by sending empty request to queue
-    for i in range(num_threads):
-        queue.put(None)
-    # wait for pending rendering jobs to complete
-    queue.join()
-    for i in range(num_threads):
-        renderers[i].join()
+                yield (x, y, z)
+
+
+def render_tiles(bbox, mapfile, tile_dir, minZoom=1,maxZoom=18, name="unknown", num_processes=None, tms_scheme=False, index=None, store=None):
+    """Render the tiles of bbox, or only the non-empty tiles of index
+       (a TileIndex), if it is given.
+       Tiles are grouped in chunks of METATILE x METATILE tiles and
+       rendered by a pool of num_processes processes (default: number of
+       CPUs).
+       Tiles are saved as tile_dir/z/x/y.png files or, if store is given
+       (e.g. a MBTilesStore), written to it by this process.
+       Return the number of rendered tiles.
+    """
+    print "render_tiles(",bbox, mapfile, tile_dir, minZoom,maxZoom, name,")\n..."
+
+    if not os.path.isdir(tile_dir):
+         os.mkdir(tile_dir)
+
+    if index is None:
+        tiles = bbox_tiles(bbox, minZoom, maxZoom)
+    else:
+        print "{0} non-empty tiles".format(len(index))
+        tiles = index.walk()
+
+    chunks = {}
+    for (x, y, z) in tiles:
+        if store is not None:
+            chunks.setdefault((z, x // METATILE, y // METATILE), []).append(
+                (None, x, y, z))
+            continue
+        # check if we have directories in place
+        zoom = "%s" % z
+        str_x = "%s" % x
+        if not os.path.isdir(tile_dir + zoom + '/' + str_x):
+            os.makedirs(tile_dir + zoom + '/' + str_x)
+        # flip y to match OSGEO TMS spec
+        if tms_scheme:
+            str_y = "%s" % ((2**z-1) - y)
+        else:
+            str_y = "%s" % y
+        tile_uri = tile_dir + zoom + '/' + str_x + '/' + str_y + '.png'
+        chunks.setdefault((z, x // METATILE, y // METATILE), []).append(
+            (tile_uri, x, y, z))
+    if not chunks:
+        if store is not None:
+            store.close()
+        return 0
+
+    if num_processes is None:
+        num_processes = cpu_count()
+    num_processes = min(num_processes, len(chunks))
+    total = sum(len(chunk) for chunk in chunks.values())
+    print "render {0} tiles in {1} chunks with {2} processes".format(
+        total, len(chunks), num_processes)
+
+    pool = Pool(num_processes, init_renderer, (tile_dir, mapfile, maxZoom))
+    start = time.time()
+    last_report = start
+    done = 0
+    try:
+        for (count, data) in pool.imap_unordered(
+                render_chunk, [chunks[k] for k in sorted(chunks)]):
+            for (x, y, z, tile) in data:
+                store.write(z, x, y, tile)
+            done += count
+            now = time.time()
+            if now - last_report >= 10 or done == total:
+                last_report = now
+                print "{0}/{1} tiles ({2:.1f} tiles/s)".format(
+                    done, total, done / max(now - start, 0.001))
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise SystemExit("Ctrl-c detected, exiting...")
+    finally:
+        pool.close()
+        pool.join()
+    if store is not None:
+        store.close()
+    return done
 
 
 if __name__ == "__main__":
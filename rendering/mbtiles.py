@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import gzip
+import shutil
+import sqlite3
+import hashlib
+from cStringIO import StringIO
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+
+CONTENT_TYPES = {"png": "image/png",
+                 "pbf": "application/x-protobuf"}
+
+
+def gzip_data(data):
+    """Return data compressed with gzip. The header has no timestamp, so
+       equal tiles are compressed in equal data.
+    """
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+class MBTilesStore:
+    """Write tiles in a MBTiles file (a SQLite database).
+       Tiles are inserted in batches. y is flipped, since MBTiles uses the
+       TMS scheme. Equal tiles (e.g. the tiles of a long straight line)
+       are stored once, in the images table, referenced by their hash.
+       The file is written as path.tmp and renamed as path when it is
+       closed, so the tiles of a previous execution can be served until
+       then. With update=True the tiles of the existing file are kept,
+       so that only some of them can be written or deleted.
+       Vector tiles ("pbf" format) are compressed with gzip, as required
+       by the MBTiles specification.
+    """
+    def __init__(self, path, metadata, batch_size=1000, update=False):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.batch_size = batch_size
+        self.compress = metadata.get("format") == "pbf"
+        if os.path.isfile(self.tmp_path):
+            os.remove(self.tmp_path)
+        update = update and os.path.isfile(path)
+        if update:
+            shutil.copyfile(path, self.tmp_path)
+        self.connection = sqlite3.connect(self.tmp_path)
+        self.connection.executescript("""
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;""")
+        if update:
+            self.connection.execute("DELETE FROM metadata;")
+            self.hashes = set(row[0] for row in self.connection.execute(
+                "SELECT tile_id FROM images;"))
+        else:
+            self.connection.executescript("""
+                CREATE TABLE metadata (name TEXT, value TEXT);
+                CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER,
+                                  tile_row INTEGER, tile_id TEXT);
+                CREATE TABLE images (tile_id TEXT PRIMARY KEY,
+                                     tile_data BLOB);
+                CREATE UNIQUE INDEX map_index
+                ON map (zoom_level, tile_column, tile_row);
+                CREATE VIEW tiles AS
+                SELECT zoom_level, tile_column, tile_row, tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;""")
+            self.hashes = set()
+        self.connection.executemany(
+            "INSERT INTO metadata (name, value) VALUES (?, ?);",
+            sorted(metadata.items()))
+        self.tiles = []
+        self.images = {}
+        self.deleted = []
+        self.count = 0
+
+    def write(self, z, x, y, data):
+        data = bytes(data)
+        if self.compress:
+            data = gzip_data(data)
+        tile_id = hashlib.md5(data).hexdigest()
+        if tile_id not in self.hashes:
+            self.hashes.add(tile_id)
+            self.images[tile_id] = sqlite3.Binary(data)
+        self.tiles.append((z, x, 2 ** z - 1 - y, tile_id))
+        self.count += 1
+        if len(self.tiles) == self.batch_size:
+            self.flush()
+
+    def delete(self, z, x, y):
+        self.deleted.append((z, x, 2 ** z - 1 - y))
+        if len(self.deleted) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.connection.executemany(
+            "DELETE FROM map WHERE zoom_level = ? AND tile_column = ? "
+            "AND tile_row = ?;", self.deleted)
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO images VALUES (?, ?);",
+            self.images.items())
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?);", self.tiles)
+        self.connection.commit()
+        self.tiles = []
+        self.images = {}
+        self.deleted = []
+
+    def close(self):
+        self.flush()
+        # Remove the images of deleted or replaced tiles
+        self.connection.execute("""
+            DELETE FROM images
+            WHERE tile_id NOT IN (SELECT tile_id FROM map);""")
+        self.connection.commit()
+        self.connection.close()
+        os.rename(self.tmp_path, self.path)
+        print "{0} tiles written to {1}".format(self.count, self.path)
+
+
+def read_tile(path, z, x, y):
+    """Return the data of a tile of a MBTiles file, None if it is missing.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        row = connection.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? "
+            "AND tile_column = ? AND tile_row = ?;",
+            (z, x, 2 ** z - 1 - y)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    return str(row[0])
+
+
+class TilesRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serve the files of the current directory. Requests of tiles of a
+       directory, e.g. dir/z/x/y.png, are answered with the tiles of
+       dir.mbtiles, if it exists.
+    """
+    tile_path = re.compile(r"^/(.+)/(\d+)/(\d+)/(\d+)\.(png|pbf)$")
+
+    def do_GET(self):
+        match = self.tile_path.match(self.path.split("?")[0])
+        if match is not None:
+            mbtiles = self.translate_path("/" + match.group(1)) + ".mbtiles"
+            if os.path.isfile(mbtiles):
+                (z, x, y) = [int(n) for n in match.group(2, 3, 4)]
+                self.send_tile(read_tile(mbtiles, z, x, y),
+                               CONTENT_TYPES[match.group(5)])
+                return
+        SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_tile(self, data, content_type):
+        if data is None:
+            self.send_error(404, "Tile not found")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        # Vector tiles are stored compressed
+        if data.startswith("\x1f\x8b"):
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TilesServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(directory, port=8000):
+    """Serve directory (e.g. the html directory of a project), with the
+       tiles of its MBTiles files, at http://localhost:port/
+    """
+    os.chdir(directory)
+    server = TilesServer(("", port), TilesRequestHandler)
+    print "Serving {0} at http://localhost:{1}/ (Ctrl-c to stop)".format(
+        directory, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print ""
+    finally:
+        server.server_close()
@@ -17,14 +17,20 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import mapnik
-from generate_tiles import render_tiles
+from generate_tiles import render_tiles, TileIndex
+from mbtiles import MBTilesStore
 import os
+import json
+import gzip
+import shutil
+import hashlib
 import jinja2
 
 
 class Renderer:
     def __init__(self, task, status, shapefile, geometry_type):
         self.task = task
+        self.status = status
         stylesheet_template = "style_{0}.xml".format(geometry_type)
         self.stylesheet = os.path.join(task.app.directory,
                                        "rendering",
@@ -34,7 +40,13 @@ class Renderer:
                                   '{0}.png'.format(status))
         self.tiles_dir = os.path.join(self.task.map_data_dir_tiles,
                                       status) + "/"
-        os.makedirs(self.tiles_dir)
+        self.mbtiles = os.path.join(self.task.map_data_dir_tiles,
+                                    "{0}.mbtiles".format(status))
+        # Number of rendered tiles
+        self.tiles_count = 0
+        # Geometries of the results and configuration of the rendered tiles
+        self.snapshot_file = self.task.tiles_snapshot_files[
+            self.task.statuses.index(status)]
 
         # Generate Mapnik style
         template_loader = jinja2.FileSystemLoader(os.path.join(
@@ -63,18 +75,107 @@ class Renderer:
         print "rendered image to '{0}'".format(self.image)
 
     def execute_generate_tiles(self):
+        """Render the tiles of the results. If the tiles of a previous
+           execution exist, with the same configuration, only the tiles
+           touched by the geometries added or removed since then are
+           deleted and rendered again.
+        """
         print "\n- Render tiles"
 
+        # Find the tiles with some results
+        features = {}
+        for lines in self.task.read_results(self.status):
+            features[hashlib.md5(repr(lines)).hexdigest()] = lines
+        index = TileIndex(features.itervalues(),
+                          self.task.min_zoom, self.task.max_zoom)
+
+        with open(self.stylesheet) as fp:
+            config = {"min_zoom": self.task.min_zoom,
+                      "max_zoom": self.task.max_zoom,
+                      "tiles_format": self.task.tiles_format,
+                      "style": hashlib.md5(fp.read()).hexdigest()}
+        previous = self.read_snapshot()
+        update = previous is not None and previous["config"] == config
+        if update:
+            # Tiles of the changed geometries
+            old_features = previous["features"]
+            changed = [lines for key, lines in features.iteritems()
+                       if key not in old_features]
+            changed.extend([lines for key, lines in old_features.iteritems()
+                            if key not in features])
+            print "{0} geometries changed since the previous rendering".format(
+                len(changed))
+            dirty = TileIndex(changed, self.task.min_zoom,
+                              self.task.max_zoom)
+            index = index.intersection(dirty)
+        else:
+            self.remove_tiles()
+            if not os.path.isdir(self.tiles_dir):
+                os.makedirs(self.tiles_dir)
+
+        # Tiles are written as files or in status.mbtiles
+        store = None
+        if self.task.tiles_format == "mbtiles":
+            store = MBTilesStore(
+                self.mbtiles,
+                self.task.mbtiles_metadata(
+                    "png", "{0} {1}".format(self.task.name, self.status)),
+                update=update)
+        if update:
+            self.remove_tiles(dirty, store)
+
         # Render
         print self.task.bbox, self.task.database
-        render_tiles(self.task.bbox, self.stylesheet,
+        self.tiles_count = render_tiles(self.task.bbox, self.stylesheet,
                      str(self.tiles_dir), self.task.min_zoom,
-                     self.task.max_zoom)
+                     self.task.max_zoom,
+                     num_processes=self.task.render_workers, index=index,
+                     store=store)
+        self.write_snapshot(config, features)
 
         # Delete empty folders
         self.remove_empty_directories(self.tiles_dir)
         print "Empty directories deleted."
 
+    def read_snapshot(self):
+        # The snapshot is useless if the tiles have been removed
+        if self.task.tiles_format == "mbtiles":
+            tiles = os.path.isfile(self.mbtiles)
+        else:
+            tiles = os.path.isdir(self.tiles_dir)
+        if not tiles or not os.path.isfile(self.snapshot_file):
+            return None
+        with gzip.open(self.snapshot_file) as fp:
+            return json.load(fp)
+
+    def write_snapshot(self, config, features):
+        with gzip.open(self.snapshot_file, "wb") as fp:
+            json.dump({"config": config, "features": features}, fp)
+
+    def remove_tiles(self, index=None, store=None):
+        """Remove the tiles of index, or all the tiles of the status.
+        """
+        if index is None:
+            # A MBTiles file is replaced when the new one is complete
+            if os.path.isfile(self.mbtiles) and (
+                    self.task.tiles_format != "mbtiles"):
+                os.remove(self.mbtiles)
+            if os.path.isfile(self.snapshot_file):
+                os.remove(self.snapshot_file)
+            if os.path.isdir(self.tiles_dir):
+                shutil.rmtree(self.tiles_dir)
+            return
+        for (x, y, z) in index.walk():
+            if store is not None:
+                store.delete(z, x, y)
+                continue
+            tile = os.path.join(self.tiles_dir, str(z), str(x),
+                                "{0}.png".format(y))
+            if os.path.isfile(tile):
+                os.remove(tile)
+        if store is not None:
+            store.flush()
+
     def remove_empty_directories(self, path):
         # Credit: http://dev.enekoalonso.com/2011/
         # 08/06/python-script-remove-empty-folders/
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import hashlib
+import tempfile
+import shutil
+
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of a list of (x, y) points.
+    """
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    sq_tolerance = tolerance * tolerance
+    while stack:
+        first, last = stack.pop()
+        (x1, y1) = points[first]
+        (x2, y2) = points[last]
+        dx = x2 - x1
+        dy = y2 - y1
+        length = dx * dx + dy * dy
+        max_distance = 0
+        index = first
+        for i in range(first + 1, last):
+            (x, y) = points[i]
+            if length == 0:
+                distance = (x - x1) ** 2 + (y - y1) ** 2
+            else:
+                # Squared distance from the segment
+                cross = dx * (y - y1) - dy * (x - x1)
+                distance = float(cross * cross) / length
+            if distance > max_distance:
+                max_distance = distance
+                index = i
+        if max_distance > sq_tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for i, p in enumerate(points) if keep[i]]
+
+
+class TopologyWriter:
+    """Write a quantized TopoJSON file, readable by topojson.feature(),
+       while the geometries of its layers are read.
+       Lines are quantized, simplified and stored as delta-encoded arcs.
+       Equal arcs, also if reversed, are stored once: they are found
+       through a hash index, with one entry per arc, while the arcs are
+       written to a temporary file.
+    """
+    def __init__(self, path, bbox, quantization=10000000, simplification=0):
+        (self.x0, self.y0, x1, y1) = bbox
+        self.kx = (x1 - self.x0) / (quantization - 1) or 1
+        self.ky = (y1 - self.y0) / (quantization - 1) or 1
+        # Tolerance in degrees --> quantized units
+        self.tolerance = simplification / min(self.kx, self.ky)
+        self.arcs_index = {}
+        self.arcs_count = 0
+        self.layers_count = 0
+        self.arcs = tempfile.TemporaryFile()
+        self.fp = open(path, "w")
+        self.fp.write('{{"type": "Topology", "transform": {{'
+                      '"scale": [{0!r}, {1!r}], "translate": [{2!r}, {3!r}]'
+                      '}}, "objects": {{'.format(self.kx, self.ky,
+                                                 self.x0, self.y0))
+
+    def quantize(self, line):
+        points = []
+        for (x, y) in line:
+            point = (int(round((x - self.x0) / self.kx)),
+                     int(round((y - self.y0) / self.ky)))
+            if not points or point != points[-1]:
+                points.append(point)
+        return simplify(points, self.tolerance)
+
+    def arc(self, points):
+        """Return the index of the arc of points, ~index if reversed.
+        """
+        key = hashlib.md5(repr(points)).digest()
+        if key in self.arcs_index:
+            return self.arcs_index[key]
+        reversed_key = hashlib.md5(repr(points[::-1])).digest()
+        if reversed_key in self.arcs_index:
+            return ~self.arcs_index[reversed_key]
+        index = self.arcs_count
+        self.arcs_index[key] = index
+        self.arcs_count += 1
+
+        # Delta encoding
+        arc = [list(points[0])]
+        for i in range(1, len(points)):
+            arc.append([points[i][0] - points[i - 1][0],
+                        points[i][1] - points[i - 1][1]])
+        if index > 0:
+            self.arcs.write(",")
+        self.arcs.write(json.dumps(arc, separators=(",", ":")))
+        return index
+
+    def add_layer(self, name, geometries):
+        """geometries is an iterable of lists of lines (lists of (x, y)).
+        """
+        if self.layers_count > 0:
+            self.fp.write(",")
+        self.fp.write('"{0}": {{"type": "GeometryCollection", '
+                      '"geometries": ['.format(name))
+        count = 0
+        for lines in geometries:
+            arcs = []
+            for line in lines:
+                points = self.quantize(line)
+                if len(points) > 1:
+                    arcs.append(self.arc(points))
+            if not arcs:
+                continue
+            if count > 0:
+                self.fp.write(",")
+            if len(arcs) == 1:
+                geometry = {"type": "LineString", "arcs": arcs}
+            else:
+                geometry = {"type": "MultiLineString",
+                            "arcs": [[a] for a in arcs]}
+            self.fp.write(json.dumps(geometry, separators=(",", ":")))
+            count += 1
+        self.fp.write("]}")
+        self.layers_count += 1
+        return count
+
+    def close(self):
+        self.fp.write('}, "arcs": [')
+        self.arcs.seek(0)
+        shutil.copyfileobj(self.arcs, self.fp)
+        self.fp.write("]}\n")
+        self.arcs.close()
+        self.fp.close()
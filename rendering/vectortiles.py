@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from math import pi, log, tan, cos, floor
+from topology import simplify
+
+DEG_TO_RAD = pi / 180
+EXTENT = 4096
+# Lines are kept up to BUFFER tile units outside the tile, so that their
+# width is not cut at tiles' edges
+BUFFER = 64
+
+
+# Protocol buffers encoding of Mapbox Vector Tiles (version 2)
+def varint(n):
+    data = bytearray()
+    while n > 0x7f:
+        data.append((n & 0x7f) | 0x80)
+        n >>= 7
+    data.append(n)
+    return data
+
+
+def zigzag(n):
+    if n >= 0:
+        return n << 1
+    return ((-n) << 1) - 1
+
+
+def field(number, value):
+    """Encode a varint (int) or length-delimited (bytearray) field.
+    """
+    if isinstance(value, bytearray):
+        return varint((number << 3) | 2) + varint(len(value)) + value
+    return varint((number << 3) | 0) + varint(value)
+
+
+def encode_lines(lines):
+    """Encode the geometry of a LINESTRING feature: a MoveTo and a LineTo
+       command for each line, with delta-encoded integer coordinates.
+    """
+    data = bytearray()
+    cx = cy = 0
+    for line in lines:
+        data += varint((1 << 3) | 1)
+        for i, (x, y) in enumerate(line):
+            if i == 1:
+                data += varint(((len(line) - 1) << 3) | 2)
+            data += varint(zigzag(x - cx)) + varint(zigzag(y - cy))
+            (cx, cy) = (x, y)
+    return data
+
+
+def encode_tile(layers):
+    """layers: {name: [lines of a feature, ...]}
+    """
+    tile = bytearray()
+    for name in sorted(layers):
+        layer = field(15, 2) + field(1, bytearray(name))
+        for lines in layers[name]:
+            feature = field(3, 2) + field(4, encode_lines(lines))
+            layer += field(2, feature)
+        layer += field(5, EXTENT)
+        tile += field(3, layer)
+    return tile
+
+
+def project(line, zoom):
+    """Project (lon, lat) points to tile units of the whole map at zoom.
+    """
+    size = EXTENT * 2 ** zoom
+    points = []
+    for (lon, lat) in line:
+        lat = max(min(lat, 85.0511), -85.0511) * DEG_TO_RAD
+        points.append(((lon + 180.0) / 360.0 * size,
+                       (1 - log(tan(lat) + 1 / cos(lat)) / pi) / 2 * size))
+    return points
+
+
+def clip_segment(p0, p1, box):
+    """Liang-Barsky clipping of a segment to box (minx, miny, maxx, maxy).
+       Return the clipped segment or None.
+    """
+    (x0, y0) = p0
+    dx = p1[0] - x0
+    dy = p1[1] - y0
+    t0 = 0.0
+    t1 = 1.0
+    for p, q in ((-dx, x0 - box[0]), (dx, box[2] - x0),
+                 (-dy, y0 - box[1]), (dy, box[3] - y0)):
+        if p == 0:
+            if q < 0:
+                return None
+            continue
+        t = float(q) / p
+        if p < 0:
+            if t > t1:
+                return None
+            t0 = max(t0, t)
+        else:
+            if t < t0:
+                return None
+            t1 = min(t1, t)
+    return ((x0 + t0 * dx, y0 + t0 * dy), (x0 + t1 * dx, y0 + t1 * dy))
+
+
+def clip_line(points, box):
+    """Return the pieces of a line inside box.
+    """
+    pieces = []
+    piece = []
+    for i in range(1, len(points)):
+        segment = clip_segment(points[i - 1], points[i], box)
+        if segment is None:
+            if piece:
+                pieces.append(piece)
+                piece = []
+            continue
+        if piece and piece[-1] == segment[0]:
+            piece.append(segment[1])
+        else:
+            if piece:
+                pieces.append(piece)
+            piece = list(segment)
+        if segment[1] != points[i]:
+            # The line exits the box
+            pieces.append(piece)
+            piece = []
+    if piece:
+        pieces.append(piece)
+    return pieces
+
+
+def cut_tiles(geometries, zoom, simplification=1.0):
+    """Return {(x, y): [lines of a feature, ...]} with the geometries
+       clipped to the tiles of zoom, in tile coordinates.
+       Lines are simplified with a tolerance of simplification pixels.
+    """
+    tiles = {}
+    tolerance = simplification * EXTENT / 256
+    for lines in geometries:
+        features = {}
+        for line in lines:
+            points = simplify(project(line, zoom), tolerance)
+            if len(points) < 2:
+                continue
+            xs = [p[0] for p in points]
+            ys = [p[1] for p in points]
+            for tx in range(int(floor((min(xs) - BUFFER) / EXTENT)),
+                            int(floor((max(xs) + BUFFER) / EXTENT)) + 1):
+                if tx < 0 or tx >= 2 ** zoom:
+                    continue
+                for ty in range(int(floor((min(ys) - BUFFER) / EXTENT)),
+                                int(floor((max(ys) + BUFFER) / EXTENT)) + 1):
+                    if ty < 0 or ty >= 2 ** zoom:
+                        continue
+                    box = (tx * EXTENT - BUFFER, ty * EXTENT - BUFFER,
+                           (tx + 1) * EXTENT + BUFFER,
+                           (ty + 1) * EXTENT + BUFFER)
+                    for piece in clip_line(points, box):
+                        local = []
+                        for (x, y) in piece:
+                            point = (int(round(x - tx * EXTENT)),
+                                     int(round(y - ty * EXTENT)))
+                            if not local or point != local[-1]:
+                                local.append(point)
+                        if len(local) > 1:
+                            features.setdefault((tx, ty), []).append(local)
+        for tile, feature_lines in features.iteritems():
+            tiles.setdefault(tile, []).append(feature_lines)
+    return tiles
+
+
+class DirectoryStore:
+    """Write tiles as tiles_dir/z/x/y.pbf files.
+    """
+    def __init__(self, tiles_dir):
+        self.tiles_dir = tiles_dir
+
+    def write(self, z, x, y, data):
+        directory = os.path.join(self.tiles_dir, str(z), str(x))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "{0}.pbf".format(y)), "wb") as f:
+            f.write(data)
+
+    def close(self):
+        pass
+
+
+def write_vector_tiles(read_layer, layers, store, min_zoom, max_zoom,
+                       simplification=1.0):
+    """Write a vector tile for each tile with some features of layers.
+       read_layer(name) returns an iterable over the geometries of a
+       layer, as lists of lines. Return the number of written tiles.
+    """
+    count = 0
+    for zoom in range(min_zoom, max_zoom + 1):
+        tiles = {}
+        for name in layers:
+            for tile, features in cut_tiles(read_layer(name), zoom,
+                                            simplification).iteritems():
+                tiles.setdefault(tile, {})[name] = features
+        for (x, y) in sorted(tiles):
+            store.write(zoom, x, y, encode_tile(tiles[(x, y)]))
+        print "zoom {0}: {1} tiles".format(zoom, len(tiles))
+        count += len(tiles)
+    store.close()
+    return count
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Copyright Simone F. <groppo8@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from math import cos, radians, degrees, atan2, hypot, ceil
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+
+class LocalProjection:
+    """Equirectangular projection in meters around the latitude lat0.
+       Accurate enough to compare distances of a few meters in a zone.
+    """
+    def __init__(self, lat0):
+        self.kx = METERS_PER_DEGREE * cos(radians(lat0))
+        self.ky = METERS_PER_DEGREE
+
+    def project(self, lon, lat):
+        return (lon * self.kx, lat * self.ky)
+
+
+def heading(x0, y0, x1, y1):
+    """Direction of a segment in degrees [0, 180), without orientation.
+    """
+    return degrees(atan2(y1 - y0, x1 - x0)) % 180
+
+
+def split_line(points, length, projection):
+    """Split a line (list of (lon, lat)) in segments of length meters at
+       most. Yield (lon0, lat0, lon1, lat1, x0, y0, x1, y1) of each
+       segment, with x, y in meters.
+    """
+    for i in range(1, len(points)):
+        (lon0, lat0) = points[i - 1][:2]
+        (lon1, lat1) = points[i][:2]
+        (x0, y0) = projection.project(lon0, lat0)
+        (x1, y1) = projection.project(lon1, lat1)
+        n = max(int(ceil(hypot(x1 - x0, y1 - y0) / length)), 1)
+        for j in range(n):
+            a = float(j) / n
+            b = float(j + 1) / n
+            yield (lon0 + (lon1 - lon0) * a, lat0 + (lat1 - lat0) * a,
+                   lon0 + (lon1 - lon0) * b, lat0 + (lat1 - lat0) * b,
+                   x0 + (x1 - x0) * a, y0 + (y1 - y0) * a,
+                   x0 + (x1 - x0) * b, y0 + (y1 - y0) * b)
+
+
+def merge_runs(segments):
+    """segments: (way_id, seq, lon0, lat0, lon1, lat1) sorted by way_id
+       and seq. Yield (way_id, points) of the lines made by consecutive
+       segments of a way.
+    """
+    line = []
+    last = None
+    for (way_id, seq, lon0, lat0, lon1, lat1) in segments:
+        if last is None or last != (way_id, seq - 1):
+            if line:
+                yield (last[0], line)
+            line = [(lon0, lat0)]
+        line.append((lon1, lat1))
+        last = (way_id, seq)
+    if line:
+        yield (last[0], line)
+
+
+def linestring_wkt(points):
+    return "LINESTRING({0})".format(
+        ", ".join(["{0!r} {1!r}".format(x, y) for (x, y) in points]))
@@ -17,14 +17,27 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import re
 import sys
-from subprocess import call, Popen, PIPE
+import json
+import shutil
+from multiprocessing import cpu_count
+from subprocess import call
 from rendering.renderer import Renderer
+from rendering.topology import TopologyWriter
+from rendering.vectortiles import write_vector_tiles, DirectoryStore
+from rendering.mbtiles import MBTilesStore
+from database import SESSIONS
+from metrics import Metrics
 
 
 class Task():
     def __init__(self, project, config):
         self.app = project.app
+        self.render_workers = project.render_workers
+        self.overpass_url = project.overpass_url
+        # Cache of OSM extracts (--cache_dir), None if it is not used
+        self.osm_cache = project.osm_cache
         self.statuses = ("notinosm", "onlyinosm")
 
         # Mandatory parameters
@@ -58,6 +71,7 @@ class Task():
         # OSM data
         self.overpass_query = ""
         self.osmfilter_command = ""
+        changes_dir = ""
         if "osm_data" in config["data"]:
             if "overpass_query" in config["data"]["osm_data"]:
                 self.overpass_query = \
@@ -65,6 +79,8 @@ class Task():
             if "osmfilter_command" in config["data"]["osm_data"]:
                 self.osmfilter_command = \
                     config["data"]["osm_data"]["osmfilter_command"]
+            if "changes_dir" in config["data"]["osm_data"]:
+                changes_dir = config["data"]["osm_data"]["changes_dir"]
 
         self.osm_dir = os.path.join(project.data_dir, "osm_data", self.name)
         if not os.path.exists(self.osm_dir):
@@ -74,6 +90,14 @@ class Task():
                                          "{0}.pbf".format(self.name))
         self.osm_file_o5m = os.path.join(self.osm_dir,
                                          "{0}.o5m".format(self.name))
+        # Replication sequence number of osm_file_pbf and directory with
+        # the change files used by --update_osm
+        self.osm_state_file = os.path.join(self.osm_dir,
+                                           "{0}.state.txt".format(self.name))
+        if changes_dir == "":
+            self.osm_changes_dir = ""
+        else:
+            self.osm_changes_dir = os.path.join(self.osm_dir, changes_dir)
 
         # Output config
         if "output" not in config:
@@ -83,26 +107,113 @@ class Task():
         else:
             self.output = config["output"]["type"]
             if "min_zoom" not in config["output"]:
-                self.min_zoom = "5"
-                self.max_zoom = "11"
+                self.min_zoom = 5
+                self.max_zoom = 11
             else:
                 self.min_zoom = int(config["output"]["min_zoom"])
                 self.max_zoom = int(config["output"]["max_zoom"])
 
+        # Analysis config
+        self.grid = 1
+        self.workers = cpu_count()
+        self.tolerance_m = None
+        self.quad_segs = None
+        self.comparison = "buffers"
+        self.segment_length = 5.0
+        self.max_angle = 30.0
+        self.parallel_workers = None
+        if "analysis" in config:
+            if "grid" in config["analysis"]:
+                self.grid = int(config["analysis"]["grid"])
+            if "workers" in config["analysis"]:
+                self.workers = int(config["analysis"]["workers"])
+            if "tolerance_m" in config["analysis"]:
+                self.tolerance_m = float(config["analysis"]["tolerance_m"])
+                self.quad_segs = 2
+            if "quad_segs" in config["analysis"]:
+                self.quad_segs = int(config["analysis"]["quad_segs"])
+            if "comparison" in config["analysis"]:
+                self.comparison = config["analysis"]["comparison"]
+                if self.comparison not in ("buffers", "segments"):
+                    sys.exit("\n* Error: unknown comparison \"{0}\" in "
+                             "task {1}. Use \"buffers\" or "
+                             "\"segments\"".format(self.comparison,
+                                                   self.name))
+            if "segment_length" in config["analysis"]:
+                self.segment_length = float(
+                    config["analysis"]["segment_length"])
+            if "max_angle" in config["analysis"]:
+                self.max_angle = float(config["analysis"]["max_angle"])
+            if "parallel_workers" in config["analysis"]:
+                self.parallel_workers = int(
+                    config["analysis"]["parallel_workers"])
+
         # Output data
         self.output_dir = os.path.join(project.data_dir, "output", self.name)
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
 
+        # Export config
+        self.export_formats = ["GeoJSON", "Shapefile"]
+        self.precision = 7
+        self.geojson_sequence = False
+        self.geojson_gzip = False
+        if "output" in config:
+            if "formats" in config["output"]:
+                self.export_formats = config["output"]["formats"]
+            if "precision" in config["output"]:
+                self.precision = int(config["output"]["precision"])
+            if "geojson" in config["output"]:
+                self.geojson_sequence = (config["output"]["geojson"] ==
+                                         "sequence")
+            if "gzip" in config["output"]:
+                self.geojson_gzip = config["output"]["gzip"]
+        # TopoJSON config
+        self.quantization = 10000000
+        self.simplification = 0
+        if "output" in config:
+            if "quantization" in config["output"]:
+                self.quantization = int(config["output"]["quantization"])
+            if "simplification" in config["output"]:
+                self.simplification = float(
+                    config["output"]["simplification"])
+
+        if self.output == "raster" and "Shapefile" not in self.export_formats:
+            sys.exit("* Error: \"raster\" output needs the Shapefile format."
+                     " Check \"formats\" in output of task {0}".format(
+                         self.name))
+
+        # Vector tiles config
+        self.tiles_format = "directory"
+        self.mvt_simplification = 1.0
+        if "output" in config:
+            if "tiles_format" in config["output"]:
+                self.tiles_format = config["output"]["tiles_format"]
+            if "mvt_simplification" in config["output"]:
+                self.mvt_simplification = float(
+                    config["output"]["mvt_simplification"])
+
+        if self.geojson_gzip:
+            geojson_extension = "GeoJSON.gz"
+        else:
+            geojson_extension = "GeoJSON"
         self.geojson_files = [os.path.join(self.output_dir,
-                              "{0}.GeoJSON".format(status))
+                              "{0}.{1}".format(status, geojson_extension))
                               for status in self.statuses]
 
         self.shapefiles = [os.path.join(self.output_dir,
                            "{0}.shp".format(status))
                            for status in self.statuses]
 
+        # Results drawn in the "raster" tiles, used to render again only
+        # the tiles of changed results. They are not published with the
+        # map data and they are kept by the analysis
+        self.tiles_snapshot_files = [os.path.join(self.output_dir,
+                                     "{0}_tiles.json.gz".format(status))
+                                     for status in self.statuses]
+
         # Map config from previous script execution
+        metrics_history = []
         if self.name not in project.output_stats["tasks"]:
             self.bbox = ""
             self.center = ""
@@ -112,6 +223,17 @@ class Task():
             self.bbox = output_stats["bbox"]
             self.center = output_stats["center"]
             self.analysis_time = output_stats["analysis_time"]
+            if "metrics" in output_stats:
+                metrics_history = output_stats["metrics"]
+
+        # Metrics of the stages of the analysis and of the creation of map
+        # data. With --profile, profiles are written in data/profile/task
+        if self.app.args.profile:
+            profile_dir = os.path.join(project.data_dir, "profile",
+                                       self.name)
+        else:
+            profile_dir = None
+        self.metrics = Metrics(self, metrics_history, profile_dir)
 
         # Map data
         self.map_data_dir = os.path.join(project.html_dir, "data", self.name)
@@ -119,6 +241,7 @@ class Task():
                                                   "topojson")
         self.map_data_dir_png = os.path.join(self.map_data_dir, "PNG")
         self.map_data_dir_tiles = os.path.join(self.map_data_dir, "tiles")
+        self.map_data_dir_mvt = os.path.join(self.map_data_dir, "mvt")
 
         if "postgis_user" not in config:
             self.postgis_user = ""
@@ -128,6 +251,10 @@ class Task():
             self.postgis_password = ""
         else:
             self.postgis_password = config["postgis_password"]
+        if "postgis_database" not in config:
+            self.postgis_database = "compare_to_osm"
+        else:
+            self.postgis_database = config["postgis_database"]
 
         modulename = "comparators.{0}".format(config["comparator"])
         classname = modulename[12:].title()
@@ -142,7 +269,15 @@ class Task():
                 sys.exit("* Error: you must define postgis_user and "
                          "postgis_password in project.json to use a "
                          "comparator based on PostGIS.")
-            self.database = self.name
+            # Tasks share a database, with a schema per task
+            self.database = self.postgis_database
+            self.schema = re.sub(r"[^a-z0-9_]", "_", self.name.lower())
+            if self.schema[0].isdigit():
+                self.schema = "_" + self.schema
+        # Connection used by the comparator for the whole analysis
+        self.session = SESSIONS[self.comparator.database_type](self)
+        # True if the analysis updates the database of the previous one
+        self.update = False
 
         # Additional info that may be used by
         # a custom index.html jinja2 template
@@ -152,9 +287,25 @@ class Task():
             self.info = {}
 
     def compare(self):
+        # Update the database of the previous analysis (--incremental)
+        # or create a new one
+        self.update = (self.app.args.incremental and
+                       os.path.isfile(self.database) and
+                       self.comparator.can_update())
         # Remove old output files
         print "Remove old files..."
-        self.remove_old_files_and_create_dirs(self.output_dir)
+        if self.update:
+            for f in os.listdir(self.output_dir):
+                path = os.path.join(self.output_dir, f)
+                # Keep the database and its journal
+                if not (path.startswith(self.database) or
+                        path in self.tiles_snapshot_files):
+                    os.remove(path)
+        else:
+            if self.app.args.incremental:
+                print "No database to update, the analysis is complete."
+            self.session.close()
+            self.remove_old_files_and_create_dirs(self.output_dir)
         self.comparator.analyse()
 
     def read_boundaries_bbox(self):
@@ -164,25 +315,13 @@ class Task():
             query = """
                 SELECT MbrMinX(Geometry), MbrMinY(Geometry),
                 MbrMaxX(Geometry), MbrMaxY(Geometry) FROM boundaries_file;"""
-            echo_query = Popen(["echo", query], stdout=PIPE)
-            find_bbox = Popen(["spatialite", self.database],
-                              stdin=echo_query.stdout, stdout=PIPE)
-            echo_query.stdout.close()
-            (stdoutdata, err) = find_bbox.communicate()
-            self.bbox = [float(x) for x in stdoutdata[:-1].split("|")]
         elif self.comparator.database_type == "postgis":
             query = ("SELECT ST_XMin(ST_Extent(Geometry)), "
                      "ST_YMin(ST_Extent(Geometry)), "
                      "ST_XMax(ST_Extent(Geometry)), "
                      "ST_YMax(ST_Extent(Geometry)) "
                      "FROM notinosm;")
-            echo_query = Popen(["echo", query], stdout=PIPE)
-            find_bbox = Popen(["psql", self.database],
-                              stdin=echo_query.stdout, stdout=PIPE)
-            echo_query.stdout.close()
-            (stdoutdata, err) = find_bbox.communicate()
-            self.bbox = [float(x.strip())
-                         for x in stdoutdata.split("\n")[2].split("|")]
+        self.bbox = [float(x) for x in self.session.query(query)[0]]
         print "bbox:", self.bbox
 
     def read_boundaries_center(self):
@@ -199,38 +338,196 @@ class Task():
                GeoJSON --> TopoJSON
            if output: "raster":
                Shapefile --> (mapnik) PNG tiles
+           if output: "mvt":
+               database --> Mapbox Vector Tiles
         """
-        # Remove old files and create missing directories
+        # Remove old files and create missing directories.
+        # Old PNG tiles are removed by Renderer, only if they cannot be
+        # updated
         print "Remove old files..."
         for directory in (self.map_data_dir_topojson,
                           self.map_data_dir_png,
-                          self.map_data_dir_tiles):
+                          self.map_data_dir_tiles,
+                          self.map_data_dir_mvt):
+            if directory == self.map_data_dir_tiles and (
+                    self.output == "raster"):
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                continue
             self.remove_old_files_and_create_dirs(directory)
 
         print ""
         if self.output == "vector":
-            cmd = "topojson -q 10000000 -o {0} {1}".format(
-                  os.path.join(self.map_data_dir_topojson, "vector.GeoJSON"),
-                  " ".join(self.geojson_files))
-            self.execute("cmd", cmd)
+            with self.metrics.stage(
+                    "topojson", (self.map_data_dir_topojson, )) as record:
+                record["features_in"] = self.count_results(self.statuses)
+                record["features_out"] = self.write_topojson()
 
         elif self.output == "raster":
-            for i, status in enumerate(self.statuses):
-                Renderer(self, status, self.shapefiles[i],
-                         self.comparator.geometry_type)
+            try:
+                for i, status in enumerate(self.statuses):
+                    tiles = os.path.join(self.map_data_dir_tiles, status)
+                    with self.metrics.stage(
+                            "render:{0}".format(status),
+                            (tiles, tiles + ".mbtiles")) as record:
+                        record["features_in"] = self.count_results((status, ))
+                        renderer = Renderer(self, status, self.shapefiles[i],
+                                            self.comparator.geometry_type)
+                        record["tiles_out"] = renderer.tiles_count
+            finally:
+                self.session.close()
+
+        elif self.output == "mvt":
+            with self.metrics.stage(
+                    "vector_tiles", (self.map_data_dir_mvt,
+                                     self.map_data_dir_mvt + ".mbtiles")
+                    ) as record:
+                record["features_in"] = self.count_results(self.statuses)
+                record["tiles_out"] = self.write_vector_tiles()
+        self.metrics.print_stages()
+
+    def count_results(self, statuses):
+        """Return the number of results of statuses, read by the creation
+           of map data.
+        """
+        return sum([self.comparator.count_rows(status)
+                    for status in statuses])
+
+    def read_results_bbox(self):
+        """Return the bbox of the analysis' results, None if they are empty
+        """
+        if self.comparator.database_type == "spatialite":
+            query = """
+                SELECT Min(MbrMinX(Geometry)), Min(MbrMinY(Geometry)),
+                Max(MbrMaxX(Geometry)), Max(MbrMaxY(Geometry))
+                FROM (SELECT Geometry FROM {0}
+                      UNION ALL
+                      SELECT Geometry FROM {1});""".format(*self.statuses)
+        elif self.comparator.database_type == "postgis":
+            query = """
+                SELECT ST_XMin(extent), ST_YMin(extent),
+                ST_XMax(extent), ST_YMax(extent)
+                FROM (SELECT ST_Extent(Geometry) AS extent
+                      FROM (SELECT Geometry FROM {0}
+                            UNION ALL
+                            SELECT Geometry FROM {1}) AS results
+                      ) AS e;""".format(*self.statuses)
+        bbox = self.session.query(query)[0]
+        if bbox[0] is None:
+            return None
+        return [float(x) for x in bbox]
+
+    def read_results(self, status):
+        """Yield the geometries of a result table as lists of lines,
+           reading them from the database in chunks. Points are yielded
+           as lines of a single point.
+        """
+        sql = "SELECT {0}(Geometry, 9) FROM {1};".format(
+            self.session.geojson_function, status)
+        for rows in self.session.stream(sql):
+            for row in rows:
+                if row[0] is None:
+                    continue
+                geometry = json.loads(row[0])
+                if geometry["type"] == "LineString":
+                    yield [geometry["coordinates"]]
+                elif geometry["type"] == "MultiLineString":
+                    yield geometry["coordinates"]
+                elif geometry["type"] == "Point":
+                    yield [[geometry["coordinates"]]]
+                elif geometry["type"] == "MultiPoint":
+                    yield [[point] for point in geometry["coordinates"]]
+
+    def output_files(self):
+        """Return the files written by the export of the results.
+        """
+        files = list(self.geojson_files)
+        for shapefile in self.shapefiles:
+            files.extend([shapefile[:-4] + extension
+                          for extension in (".shp", ".shx", ".dbf", ".prj")])
+        return files
+
+    def write_topojson(self):
+        """Write the results as a TopoJSON file with a layer per status.
+           Return the number of written features.
+        """
+        path = os.path.join(self.map_data_dir_topojson, "vector.GeoJSON")
+        features = 0
+        try:
+            bbox = self.read_results_bbox()
+            if bbox is None:
+                bbox = self.bbox
+            topology = TopologyWriter(path, bbox, self.quantization,
+                                      self.simplification)
+            for status in self.statuses:
+                count = topology.add_layer(status, self.read_results(status))
+                print "{0}: {1} features".format(status, count)
+                features += count
+            topology.close()
+            print "{0} arcs written to {1}".format(topology.arcs_count, path)
+        finally:
+            self.session.close()
+        return features
+
+    def write_vector_tiles(self):
+        """Cut the results in Mapbox Vector Tiles, with a layer per status,
+           written as mvt/z/x/y.pbf files or in a MBTiles file.
+           Return the number of written tiles.
+        """
+        if self.tiles_format == "mbtiles":
+            metadata = self.mbtiles_metadata("pbf")
+            metadata["json"] = json.dumps({"vector_layers": [
+                {"id": status, "fields": {}} for status in self.statuses]})
+            store = MBTilesStore(self.map_data_dir_mvt + ".mbtiles",
+                                 metadata)
+        else:
+            store = DirectoryStore(self.map_data_dir_mvt)
+        try:
+            return write_vector_tiles(self.read_results, self.statuses, store,
+                                      self.min_zoom, self.max_zoom,
+                                      self.mvt_simplification)
+        finally:
+            self.session.close()
+
+    def mbtiles_metadata(self, tiles_format, name=None):
+        """Return the metadata of a MBTiles file of the task's tiles.
+        """
+        bounds = self.read_results_bbox() or self.bbox
+        return {"name": name or self.name,
+                "format": tiles_format,
+                "minzoom": str(self.min_zoom),
+                "maxzoom": str(self.max_zoom),
+                "bounds": ",".join([str(x) for x in bounds])}
 
     def remove_old_files_and_create_dirs(self, directory):
+        """MBTiles files are kept, if tiles_format is "mbtiles", since they
+           are replaced only when the new tiles are ready.
+        """
+        if os.path.isfile(directory + ".mbtiles") and (
+                self.tiles_format != "mbtiles"):
+            os.remove(directory + ".mbtiles")
         if os.path.isdir(directory):
-            self.execute("cmd", "rm -r {0}/*".format(directory))
+            for file_name in os.listdir(directory):
+                path = os.path.join(directory, file_name)
+                if path.endswith(".mbtiles") and (
+                        self.tiles_format == "mbtiles"):
+                    continue
+                if path in self.tiles_snapshot_files:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
         else:
             os.makedirs(directory)
 
     def execute(self, mode, cmd):
         """mode == cmd OR spatialite OR postgis
+           SQL is executed through the task's database session,
+           commands through the shell.
         """
-        if mode == "spatialite":
-            cmd = "echo \"{0}\" | spatialite {1}".format(cmd, self.database)
-        elif mode == "postgis":
-            cmd = "echo \"{0}\" | psql -d {1}".format(cmd, self.database)
+        if mode in ("spatialite", "postgis"):
+            self.session.execute(cmd)
+            return
         print cmd
         call(cmd, shell=True)